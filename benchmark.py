@@ -0,0 +1,126 @@
+'''
+This code is used to benchmark the pipelines offline, on synthetic tickets from
+synthetic_rt.py. The db pipeline reads a SQLite fixture of the rt5 tables, and the
+rt pipeline (rt_get_ticket.main) talks to mock_rt_server.py. Every run happens in a
+fresh process, so its peak memory is its own, and reports tickets and pairs per
+second for each pipeline and corpus size. Fixtures are built before the clock starts.
+'''
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import synthetic_rt
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_db(fixture, group="headers", processes=1):
+    """Group, clean and pair the tickets of a SQLite fixture like db_get_queue does, for ascii."""
+    from sqlalchemy import create_engine
+    import db_grouping
+    import db_get_queue
+    import ticket_filters
+    engine = create_engine(f"sqlite:///{fixture}")
+    start = time.perf_counter()
+    tickets, _, _ = db_grouping.group_tickets(engine, ["ascii"], mode=group)
+    pipeline = ticket_filters.Pipeline(ticket_filters.default_stages(), processes=processes)
+    pairs, _ = db_get_queue.build_pairs(pipeline.run(tickets["ascii"]))
+    # Build every prompt, as writing the dataset would
+    for pair in pairs:
+        dict(pair)
+    seconds = time.perf_counter() - start
+    engine.dispose()
+    return {"tickets": len(tickets["ascii"]), "pairs": len(pairs), "seconds": seconds}
+
+
+def bench_rt(url, from_date, to_date, workers=1, source="rest1"):
+    """Run rt_get_ticket.main against a mock RT server."""
+    os.environ.update(RT_HOST=url, RT_UN="benchmark", RT_PW="benchmark")
+    import rt_get_ticket
+    start = time.perf_counter()
+    train, eval = rt_get_ticket.main(FromDate=from_date, ToDate=to_date, Workers=workers, Rate=1e6,
+                                     Source=source)
+    for pair in train + eval:
+        dict(pair)
+    seconds = time.perf_counter() - start
+    tickets = len({pair["ticket_id"] for pair in train + eval})
+    return {"tickets_with_pairs": tickets, "pairs": len(train) + len(eval), "seconds": seconds}
+
+
+def _run(bench, args):
+    # Runs in a fresh process
+    try:
+        result = bench(*args)
+    except ImportError as e:
+        return {"skipped": f"missing module {e.name}"}
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_case(bench, *args):
+    # Not a multiprocessing.Pool, its daemon workers could not start the db pipeline's own pool
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run, bench, args).result()
+
+
+def main(Sizes=(100, 1000), Pipelines=("db", "rt"), Seed=0, Group="headers", Processes=1, Workers=1,
+         Latency=0.0, WorkDir=None, Output=None):
+    workdir = WorkDir or tempfile.mkdtemp(prefix="rt_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for size in Sizes:
+        corpus = synthetic_rt.Corpus(size, seed=Seed)
+        if "db" in Pipelines:
+            fixture = os.path.join(workdir, f"rt5_{size}_{Seed}.sqlite")
+            if not os.path.exists(fixture):
+                synthetic_rt.write_sqlite(corpus, fixture)
+            result = run_case(bench_db, fixture, Group, Processes)
+            results.append(dict(pipeline="db", size=size, **result))
+        for source in [p for p in ("rt", "rest2") if p in Pipelines]:
+            import mock_rt_server
+            # The server runs in this process, so it does not share the GIL with the pipeline
+            server, url = mock_rt_server.serve(corpus, latency=Latency)
+            dates = [ticket["Created"] for ticket in corpus.tickets]
+            from_date = time.strftime("%Y-%m-%d", time.strptime(dates[0], "%a %b %d %H:%M:%S %Y"))
+            last = time.mktime(time.strptime(dates[-1], "%a %b %d %H:%M:%S %Y")) + 86400
+            result = run_case(bench_rt, url, from_date, time.strftime("%Y-%m-%d", time.localtime(last)), Workers,
+                              "rest1" if source == "rt" else source)
+            result["rt_requests"] = server.mock.requests
+            server.shutdown()
+            results.append(dict(pipeline=source, size=size, **result))
+        print(json.dumps(results[-1]))
+
+    # "corpus" is the number of synthetic tickets every pipeline reads, kept or dropped
+    print(f"{'pipeline':>8} {'corpus':>8} {'pairs':>8} {'seconds':>8} {'tickets/s':>10} {'pairs/s':>10} {'peak MB':>8}")
+    for r in results:
+        if "skipped" in r:
+            print(f"{r['pipeline']:>8} {r['size']:>8} skipped, {r['skipped']}")
+            continue
+        print(f"{r['pipeline']:>8} {r['size']:>8} {r['pairs']:>8} {r['seconds']:>8.2f} "
+              f"{r['size'] / r['seconds']:>10.1f} {r['pairs'] / r['seconds']:>10.1f} {r['peak_rss_mb']:>8.1f}")
+    if Output:
+        with open(Output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the db and rt pipelines on synthetic tickets')
+    parser.add_argument('--Sizes', type=int, nargs='+', default=[100, 1000], help='Numbers of tickets to run with')
+    parser.add_argument('--Pipelines', nargs='+', choices=['db', 'rt', 'rest2'], default=['db', 'rt'],
+                        help='rest2 is the rt pipeline fetching histories in bulk through REST 2.0')
+    parser.add_argument('--Seed', type=int, default=0, help='Seed of the synthetic corpus')
+    parser.add_argument('--Group', choices=['headers', 'sql'], default='headers', help='Grouping mode of the db pipeline')
+    parser.add_argument('--Processes', type=int, default=1, help='Processes cleaning tickets in the db pipeline')
+    parser.add_argument('--Workers', type=int, default=1, help='Concurrent RT requests in the rt pipeline')
+    parser.add_argument('--Latency', type=float, default=0.0, help='Seconds the mock RT server waits per request')
+    parser.add_argument('--WorkDir', help='Directory to keep fixtures in, a temporary one by default')
+    parser.add_argument('--Output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+    main(Sizes=args.Sizes, Pipelines=args.Pipelines, Seed=args.Seed, Group=args.Group, Processes=args.Processes,
+         Workers=args.Workers, Latency=args.Latency, WorkDir=args.WorkDir, Output=args.Output)
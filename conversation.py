@@ -0,0 +1,133 @@
+'''
+This code is used to keep the QA pairs of a ticket without copying its conversation
+into every pair. The turns of a ticket are stored once in a Conversation, and a Pair
+only points at the conversation and the turn it answers. The prompt of a pair, the
+conversation before that turn, is cut out of the shared text when the pair is
+written. The compact JSON lines format stores every conversation once, followed by
+one short line per pair, and read_pairs rebuilds the full pairs from it.
+'''
+from collections.abc import Mapping
+
+REJECTED = " Please submit a ticket through the portal: https://tacc.utexas.edu/portal/dashboard. "
+
+
+class Style:
+    """How the turns of a conversation are written into a prompt, named in compact records."""
+    def __init__(self, name, turn_format, prompt_suffix):
+        self.name = name
+        self.turn_format = turn_format
+        self.prompt_suffix = prompt_suffix
+
+
+# rt_get_ticket: "Human: ...\nAssistant: ...\nAssistant:"
+RT_STYLE = Style("rt", "{}: {}\n", "Assistant:")
+# db_get_queue: " Human: ... Assistant: ... Assistant:"
+DB_STYLE = Style("db", " {}: {}", " Assistant:")
+STYLES = {style.name: style for style in (RT_STYLE, DB_STYLE)}
+
+
+class Conversation:
+    """Turns of a ticket as (speaker, text), with the fields every pair of the ticket shares.
+
+    `before` fields come ahead of the prompt in a pair and `after` fields behind
+    "rejected", e.g. category and queue, or ticket_id. `ticket_id` names the ticket
+    when it is not one of the fields.
+    """
+    def __init__(self, turns, style, before=None, after=None, ticket_id=None):
+        self.ticket_id = ticket_id
+        self.turns = turns
+        self.style = style
+        self.before = before or {}
+        self.after = after or {}
+        self._text = None
+        self._ends = None
+
+    def _render(self):
+        # The whole conversation as one string, and where every turn ends in it
+        parts, ends, end = [], [0], 0
+        for speaker, text in self.turns:
+            parts.append(self.style.turn_format.format(speaker, text))
+            end += len(parts[-1])
+            ends.append(end)
+        self._text, self._ends = "".join(parts), ends
+
+    def ends(self):
+        """Length of the conversation text up to the end of every turn, starting with 0."""
+        if self._text is None:
+            self._render()
+        return self._ends
+
+    def prompt(self, turn, start=0):
+        """The conversation from `start` up to `turn`, ready for the answer."""
+        ends = self.ends()
+        return self._text[ends[start]:ends[turn]] + self.style.prompt_suffix
+
+    def key(self):
+        if self.ticket_id is not None:
+            return self.ticket_id
+        return self.after.get("ticket_id", self.before.get("ticket_id", id(self)))
+
+    def to_record(self):
+        # By name, a conversation sent back from a worker process has its own copy of the style
+        return {"conversation": self.key(), "style": self.style.name, "turns": self.turns,
+                "before": self.before, "after": self.after}
+
+    @classmethod
+    def from_record(cls, record):
+        return cls([tuple(turn) for turn in record["turns"]], STYLES[record["style"]],
+                   record["before"], record["after"], ticket_id=record["conversation"])
+
+
+class Pair(Mapping):
+    """A QA pair, the answer of `turn` in `conversation`. Reads like the pair dict it stands for.
+
+    The prompt starts at turn `start`, which is above 0 when older turns were truncated.
+    """
+    __slots__ = ("conversation", "turn", "start")
+
+    def __init__(self, conversation, turn, start=0):
+        self.conversation = conversation
+        self.turn = turn
+        self.start = start
+
+    def __getitem__(self, key):
+        conversation = self.conversation
+        if key == "prompt":
+            return conversation.prompt(self.turn, self.start)
+        if key == "chosen":
+            return " " + conversation.turns[self.turn][1]
+        if key == "rejected":
+            return REJECTED
+        if key in conversation.before:
+            return conversation.before[key]
+        return conversation.after[key]
+
+    def __iter__(self):
+        yield from self.conversation.before
+        yield from ("prompt", "chosen", "rejected")
+        yield from self.conversation.after
+
+    def __len__(self):
+        return len(self.conversation.before) + 3 + len(self.conversation.after)
+
+    def to_ref(self):
+        ref = {"conversation": self.conversation.key(), "turn": self.turn}
+        if self.start:
+            ref["start"] = self.start
+        return ref
+
+
+def read_pairs(records, materialize=True):
+    """Full pair dicts from the records of a JSON lines file, compact or not.
+
+    With materialize=False, pairs of compact records are returned as Pairs.
+    """
+    conversations = {}
+    for record in records:
+        if "turns" in record:
+            conversations[record["conversation"]] = Conversation.from_record(record)
+        elif "turn" in record and "conversation" in record:
+            pair = Pair(conversations[record["conversation"]], record["turn"], record.get("start", 0))
+            yield dict(pair) if materialize else pair
+        else:
+            yield record
@@ -0,0 +1,28 @@
+'''
+This code is used to split QA pairs into train and eval sets by ticket.
+Every ticket goes to the same split whenever it is seen, decided by a seeded hash
+of its id. All pairs of a ticket land in one split, so eval never shares turns with
+train, and the split of a ticket is known as soon as its pairs are made: nothing
+has to be shuffled in memory, and reruns over more tickets keep earlier ones in place.
+'''
+import hashlib
+
+EVAL_FRACTION = 0.1
+
+
+def is_eval(ticket_id, eval_fraction=EVAL_FRACTION, seed=0):
+    """Does the ticket belong to the eval set? The same answer on every run with the same seed."""
+    digest = hashlib.blake2b(f"{seed}:{ticket_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < eval_fraction * 2 ** 64
+
+
+def split_pairs(pairs, ticket_of, eval_fraction=EVAL_FRACTION, seed=0):
+    """(train pairs, eval pairs), in their original order, with `ticket_of(pair)` deciding the split."""
+    train, eval = [], []
+    splits = {}
+    for pair in pairs:
+        ticket_id = ticket_of(pair)
+        if ticket_id not in splits:
+            splits[ticket_id] = is_eval(ticket_id, eval_fraction, seed)
+        (eval if splits[ticket_id] else train).append(pair)
+    return train, eval
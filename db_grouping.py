@@ -0,0 +1,149 @@
+'''
+This code is used to group the emails of the rt5 database by ticket.
+In "headers" mode the ticket of every email is read from its X-RT-Ticket header,
+and emails without one are dropped. In "sql" mode MySQL joins Attachments with
+Transactions and Tickets and returns emails already ordered by ticket, so tickets
+come out one after another without parsing headers.
+'''
+from collections import Counter, deque
+import numpy as np
+import db_reader
+import email_dedup
+
+
+def email_text(content, encoding):
+    """Decode an email and leave out empty lines and lines quoting earlier emails."""
+    return _clean_text(content.decode(encoding))
+
+
+def _clean_text(text):
+    return "".join(line + "\n" for line in text.split("\n") if len(line) > 0 and line[0] != ">")
+
+
+def email_texts(content, encodings):
+    """email_text of the email for each encoding. Encodings that decode it the same,
+    like ascii and utf-8 for an ascii email, share one string."""
+    texts, cleaned = {}, []
+    for encoding in encodings:
+        decoded = content.decode(encoding)
+        text = next((text for other, text in cleaned if other == decoded), None)
+        if text is None:
+            text = _clean_text(decoded)
+            cleaned.append((decoded, text))
+        texts[encoding] = text
+    return texts
+
+
+def parse_headers(headers):
+    """Reconstruct the header to dict"""
+    header_dict = {}
+    for key_val in headers.split("\n"):
+        splits = key_val.split(": ")
+        header_key = splits[0]
+        val = ": ".join(splits[1:])
+        if len(header_key) == 0:
+            continue
+        header_dict[header_key] = val
+    return header_dict
+
+
+def _prefilter(table, encodings, stats):
+    # Rows decodable with at least one encoding, each with the encodings it decodes with
+    table, masks = db_reader.prefilter(table, encodings)
+    tiers = np.column_stack([masks[encoding].to_numpy() for encoding in encodings])
+    for encoding, decodable in zip(encodings, tiers.T):
+        stats[encoding]["emails"] += len(table)
+        stats[encoding]["no_error"] += int(decodable.sum())
+        stats[encoding]["decode_errors"] += int(len(table) - decodable.sum())
+    keep = tiers.any(axis=1)
+    for row, row_tiers in zip(table[keep].itertuples(index=False), tiers[keep]):
+        yield row, [encoding for encoding, decodable in zip(encodings, row_tiers) if decodable]
+
+
+def group_by_headers(engine, encodings, chunksize, stats, dedup_counts, updated_since=None):
+    """Tickets keyed by X-RT-Ticket per encoding, with their emails in database order."""
+    ticket_emails = {encoding: {} for encoding in encodings}
+    for table in db_reader.read_attachments(engine, chunksize=chunksize, updated_since=updated_since):
+        for row, row_encodings in _prefilter(table, encodings, stats):
+            header_dict = parse_headers(row.Headers)
+            if "X-RT-Ticket" not in header_dict.keys():
+                continue
+            ticket_key = header_dict["X-RT-Ticket"]
+            texts = email_texts(row.Content, row_encodings)
+            for encoding in row_encodings:
+                email = dict(header_dict, Email_Content=texts[encoding])
+                if ticket_key not in ticket_emails[encoding]:
+                    ticket_emails[encoding][ticket_key] = email_dedup.TicketEmails(dedup_counts[encoding])
+                ticket_emails[encoding][ticket_key].add(email, email["Email_Content"])
+    return {encoding: {key: emails.to_list() for key, emails in tickets.items()}
+            for encoding, tickets in ticket_emails.items()}
+
+
+def iter_sql_tickets(engine, encodings, chunksize, stats, dedup_counts, updated_since=None):
+    """Yield (ticket id, {encoding: emails}) one ticket at a time, in ticket id order."""
+    ticket_key, emails = None, None
+    for table in db_reader.read_ticket_attachments(engine, chunksize=chunksize, updated_since=updated_since):
+        for row, row_encodings in _prefilter(table, encodings, stats):
+            key = str(row.TicketId)
+            if key != ticket_key:
+                if emails is not None:
+                    yield ticket_key, {encoding: e.to_list() for encoding, e in emails.items()}
+                ticket_key = key
+                emails = {encoding: email_dedup.TicketEmails(dedup_counts[encoding]) for encoding in encodings}
+            texts = email_texts(row.Content, row_encodings)
+            for encoding in row_encodings:
+                email = {"X-RT-Ticket": key, "Queue": row.Queue, "Transaction-Type": row.TransactionType,
+                         "Email_Content": texts[encoding]}
+                emails[encoding].add(email, email["Email_Content"])
+    if emails is not None:
+        yield ticket_key, {encoding: e.to_list() for encoding, e in emails.items()}
+
+
+def split_encodings(stream, encodings):
+    """One iterator of (ticket id, emails) per encoding, all reading the same (ticket id,
+    {encoding: emails}) stream once. Tickets one encoding has read ahead wait in the
+    buffers of the others, so iterators consumed side by side hold only a few tickets.
+    """
+    stream = iter(stream)
+    buffers = {encoding: deque() for encoding in encodings}
+
+    def tickets(encoding):
+        buffer = buffers[encoding]
+        while True:
+            while not buffer:
+                item = next(stream, None)
+                if item is None:
+                    return
+                key, emails = item
+                for other in encodings:
+                    if emails[other]:
+                        buffers[other].append((key, emails[other]))
+            yield buffer.popleft()
+
+    return {encoding: tickets(encoding) for encoding in encodings}
+
+
+def stream_tickets(engine, encodings, chunksize=db_reader.DEFAULT_CHUNKSIZE, updated_since=None):
+    """Tickets of the "sql" mode as a stream per encoding, see split_encodings, with the
+    counters of group_tickets. The counters are complete once the streams are read."""
+    stats = {encoding: Counter() for encoding in encodings}
+    dedup_counts = {encoding: Counter() for encoding in encodings}
+    stream = iter_sql_tickets(engine, encodings, chunksize, stats, dedup_counts, updated_since)
+    return split_encodings(stream, encodings), stats, dedup_counts
+
+
+def group_tickets(engine, encodings, chunksize=db_reader.DEFAULT_CHUNKSIZE, mode="headers", updated_since=None):
+    """Group the emails by ticket in one pass over the database, separately for every encoding.
+
+    An email is grouped under each encoding it decodes with, and duplicates are
+    removed within each encoding. Returns, by encoding, the tickets, counts of
+    emails read / kept / not decodable, and how many emails each dedup rule removed.
+    With updated_since, only tickets updated after it are read.
+    """
+    if mode == "sql":
+        streams, stats, dedup_counts = stream_tickets(engine, encodings, chunksize, updated_since)
+        return {encoding: dict(streams[encoding]) for encoding in encodings}, stats, dedup_counts
+    stats = {encoding: Counter() for encoding in encodings}
+    dedup_counts = {encoding: Counter() for encoding in encodings}
+    tickets = group_by_headers(engine, encodings, chunksize, stats, dedup_counts, updated_since)
+    return tickets, stats, dedup_counts
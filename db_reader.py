@@ -0,0 +1,170 @@
+'''
+This code is used to read email data from the rt5 database in chunks.
+Only the columns used by the db_* scripts are selected, and emails with
+"AutoReply" or "Resolved" in their subjects are dropped by MySQL already,
+so the binary Content of the whole table never sits in memory at once.
+'''
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql import text
+
+# Columns of the Attachments table the pipeline actually reads
+ATTACHMENT_COLUMNS = ["id", "Subject", "Headers", "Content"]
+
+# Emails that have "AutoReply" and "Resolved" in their subjects are useless.
+# LIKE BINARY keeps the match case sensitive, same as `in` on python strings.
+ATTACHMENT_QUERY = """
+SELECT {columns}
+FROM Attachments
+WHERE Subject IS NOT NULL
+  AND Subject <> ''
+  AND Subject NOT LIKE BINARY :autoreply
+  AND Subject NOT LIKE BINARY :resolved{updated}
+ORDER BY id
+"""
+
+# Emails of tickets updated after :updated_since only, for incremental runs
+ATTACHMENT_UPDATED_FILTER = """
+  AND TransactionId IN (SELECT t.id FROM Transactions t
+                        JOIN Tickets k ON k.id = t.ObjectId AND t.ObjectType = 'RT::Ticket'
+                        JOIN Tickets e ON e.id = k.EffectiveId
+                        WHERE e.LastUpdated > :updated_since)"""
+
+DEFAULT_CHUNKSIZE = 10000
+
+
+def _subject_filter(engine, query, updated_since=None):
+    """The query and its parameters for the engine's database. SQLite, e.g. the
+    synthetic_rt benchmark fixture, has no LIKE BINARY but GLOB is case sensitive."""
+    if engine.dialect.name == "sqlite":
+        query, params = query.replace("LIKE BINARY", "GLOB"), {"autoreply": "*AutoReply*", "resolved": "*Resolved*"}
+    else:
+        params = {"autoreply": "%AutoReply%", "resolved": "%Resolved%"}
+    if updated_since:
+        params["updated_since"] = updated_since
+    return text(query), params
+
+
+def read_attachments(engine, chunksize=DEFAULT_CHUNKSIZE, columns=ATTACHMENT_COLUMNS, updated_since=None):
+    """Yield the useful rows of the Attachments table as DataFrames of at most `chunksize` rows.
+
+    A server side cursor is used, so only one chunk is held by the client at a time.
+    With chunksize=None the whole (filtered) table is returned as a single DataFrame.
+    With updated_since, only emails of tickets updated after it are read.
+    """
+    query, params = _subject_filter(engine, ATTACHMENT_QUERY.format(
+        columns=", ".join(columns), updated=ATTACHMENT_UPDATED_FILTER if updated_since else ""), updated_since)
+    with engine.connect() as conn:
+        if chunksize is None:
+            yield pd.read_sql_query(query, con=conn, params=params)
+            return
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for chunk in pd.read_sql_query(query, con=conn, params=params, chunksize=chunksize):
+            yield chunk
+
+
+def subject_mask(table):
+    """Boolean mask of emails whose subjects are non empty and not "AutoReply" or "Resolved"."""
+    subject = table["Subject"].fillna("")
+    return (subject.str.len() > 0) & \
+        ~subject.str.contains("AutoReply", regex=False) & \
+        ~subject.str.contains("Resolved", regex=False)
+
+
+def decodable_masks(table, encodings):
+    """Boolean masks of emails whose Content can be decoded with each of `encodings`.
+
+    All contents are laid out in one byte buffer and the number of non-ascii bytes
+    of every email is counted at once. Pure ascii emails decode under any encoding
+    we use, so only the remaining ones are decoded one by one (and never for ascii).
+    """
+    content = table["Content"]
+    is_bytes = content.map(lambda c: isinstance(c, bytes)).to_numpy(dtype=bool)
+    blobs = content[is_bytes]
+    lengths = blobs.map(len).to_numpy(dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    buf = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+    high = np.concatenate(([0], np.cumsum(buf >= 0x80)))
+    ascii_only = (high[ends] - high[starts]) == 0
+
+    masks = {}
+    for encoding in encodings:
+        mask = np.zeros(len(table), dtype=bool)
+        decodable = ascii_only.copy()
+        if encoding != "ascii" and not ascii_only.all():
+            rest = blobs[~ascii_only]
+            decodable[~ascii_only] = rest.map(lambda c: _decodes(c, encoding)).to_numpy(dtype=bool)
+        mask[is_bytes] = decodable
+        masks[encoding] = pd.Series(mask, index=table.index)
+    return masks
+
+
+def decodable_mask(table, encoding):
+    """Boolean mask of emails whose Content can be decoded with `encoding`."""
+    return decodable_masks(table, [encoding])[encoding]
+
+
+def _decodes(content, encoding):
+    try:
+        content.decode(encoding)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def prefilter(table, encodings):
+    """Keep the emails of a chunk with useful subjects, and tell which of `encodings` each decodes with.
+
+    Returns the kept rows and a boolean mask per encoding over them: the kept and
+    decode-error partitions for an encoding are rows[mask] and rows[~mask].
+    """
+    table = table[subject_mask(table)]
+    return table, decodable_masks(table, encodings)
+
+
+# Same emails, joined with their transactions and tickets so MySQL groups them by ticket.
+# Merged tickets are grouped under the ticket they were merged into (EffectiveId).
+TICKET_ATTACHMENT_QUERY = """
+SELECT a.id, a.Subject, a.Content,
+       k.EffectiveId AS TicketId, q.Name AS Queue, t.Type AS TransactionType
+FROM Attachments a
+JOIN Transactions t ON t.id = a.TransactionId AND t.ObjectType = 'RT::Ticket'
+JOIN Tickets k ON k.id = t.ObjectId
+JOIN Queues q ON q.id = k.Queue
+WHERE a.Subject IS NOT NULL
+  AND a.Subject <> ''
+  AND a.Subject NOT LIKE BINARY :autoreply
+  AND a.Subject NOT LIKE BINARY :resolved{updated}
+ORDER BY k.EffectiveId, t.Created, t.id, a.id
+"""
+
+TICKET_UPDATED_FILTER = """
+  AND k.EffectiveId IN (SELECT id FROM Tickets WHERE LastUpdated > :updated_since)"""
+
+
+def read_ticket_attachments(engine, chunksize=DEFAULT_CHUNKSIZE, updated_since=None):
+    """Like read_attachments, but rows come ordered by ticket and transaction time,
+    with TicketId, Queue and TransactionType columns instead of Headers."""
+    query, params = _subject_filter(engine, TICKET_ATTACHMENT_QUERY.format(
+        updated=TICKET_UPDATED_FILTER if updated_since else ""), updated_since)
+    with engine.connect() as conn:
+        if chunksize is None:
+            yield pd.read_sql_query(query, con=conn, params=params)
+            return
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for chunk in pd.read_sql_query(query, con=conn, params=params, chunksize=chunksize):
+            yield chunk
+
+
+def last_updated(engine):
+    """LastUpdated of the most recently updated ticket, the watermark of a run reading the database now."""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT MAX(LastUpdated) FROM Tickets")).scalar()
+
+
+def updated_tickets(engine, updated_since):
+    """Ids of the tickets updated after `updated_since`, merged tickets under the ticket they were merged into."""
+    query = text("SELECT DISTINCT EffectiveId FROM Tickets WHERE LastUpdated > :updated_since")
+    with engine.connect() as conn:
+        return {str(row[0]) for row in conn.execute(query, {"updated_since": updated_since})}
@@ -0,0 +1,89 @@
+'''
+This code is used to drop duplicate emails within a ticket in the db_* scripts.
+RT stores the same email several times (e.g. as sent and as received), and later
+emails often repeat earlier ones. Every kept email is indexed by a digest of its
+content and by the digests of its lines, so exact duplicates and emails whose lines
+appear in the same order inside another email are found anywhere in the ticket,
+without comparing the new email with every kept one character by character.
+The digests are 128 bit blake2b, so distinct emails or lines never share one in practice.
+'''
+from collections import defaultdict
+import hashlib
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+class TicketEmails:
+    """Emails of one ticket, in order, with duplicates removed as they are added.
+
+    `counts` collects how many emails each rule removed:
+    "exact" (same content as a kept email), "contained" (inside a kept email)
+    and "superseded" (a kept email inside the new one, which replaces it).
+    """
+    def __init__(self, counts):
+        self.counts = counts
+        self.emails = {}                    # id -> email dict, in order of arrival
+        self.lines = {}                     # id -> digests of the email's lines
+        self.contents = {}                  # content digest -> id
+        self.content_of = {}                # id -> content digest
+        self.positions = defaultdict(list)  # line digest -> [(id, line number)]
+        self.first_lines = defaultdict(set) # first line digest -> ids, empty emails under None
+        self.next_id = 0
+
+    def add(self, email, content):
+        content_hash = digest(content)
+        if content_hash in self.contents:
+            self.counts["exact"] += 1
+            return
+        lines = [digest(line) for line in content.split('\n') if line]
+        if self._contained(lines):
+            self.counts["contained"] += 1
+            return
+        for email_id in self._contained_in(lines):
+            self._remove(email_id)
+            self.counts["superseded"] += 1
+        email_id = self.next_id
+        self.next_id += 1
+        self.emails[email_id] = email
+        self.lines[email_id] = lines
+        self.contents[content_hash] = email_id
+        self.content_of[email_id] = content_hash
+        self.first_lines[lines[0] if lines else None].add(email_id)
+        for number, line in enumerate(lines):
+            self.positions[line].append((email_id, number))
+
+    def _contained(self, lines):
+        # Is this sequence of lines inside a kept email?
+        if not lines:
+            return len(self.emails) > 0
+        for email_id, number in self.positions.get(lines[0], ()):
+            if self.lines[email_id][number:number + len(lines)] == lines:
+                return True
+        return False
+
+    def _contained_in(self, lines):
+        # Kept emails whose lines all appear, in order, in this sequence of lines
+        starts = defaultdict(list)
+        for number, line in enumerate(lines):
+            starts[line].append(number)
+        found = set(self.first_lines.get(None, ()))
+        for first_line, numbers in starts.items():
+            for email_id in self.first_lines.get(first_line, ()):
+                kept = self.lines[email_id]
+                if any(lines[number:number + len(kept)] == kept for number in numbers):
+                    found.add(email_id)
+        return found
+
+    def _remove(self, email_id):
+        del self.emails[email_id]
+        lines = self.lines.pop(email_id)
+        del self.contents[self.content_of.pop(email_id)]
+        self.first_lines[lines[0] if lines else None].discard(email_id)
+        for line in set(lines):
+            self.positions[line] = [p for p in self.positions[line] if p[0] != email_id]
+
+    def to_list(self):
+        return list(self.emails.values())
+
@@ -0,0 +1,187 @@
+'''
+This code is used to prebuild the vector index of the in-context examples, so the
+example selector does not embed every example again each time the service starts.
+Examples are embedded once (by default with hashed TF-IDF, which needs no model),
+and written as a memory-mappable .npy matrix with an inverted file index next to it:
+every example belongs to the list of its nearest k-means centroid, and a query only
+scores the examples of its closest lists. The rows of each list are stored together,
+so a query reads a few contiguous slices of the matrix. Examples added after the build
+join the list of their nearest centroid in memory, until the index is built again.
+'''
+import json
+import re
+import zlib
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+class HashingTfidfEmbedder:
+    """TF-IDF over words and word bigrams hashed into `dim` buckets, L2 normalized."""
+    name = "hashed-tfidf"
+
+    def __init__(self, dim=1024, bigrams=True, idf=None):
+        self.dim = dim
+        self.bigrams = bigrams
+        self.idf = idf
+
+    def buckets(self, text):
+        words = TOKEN_RE.findall(text.lower())
+        terms = words + [a + " " + b for a, b in zip(words, words[1:])] if self.bigrams else words
+        return np.array([zlib.crc32(term.encode()) % self.dim for term in terms], dtype=np.int64)
+
+    def fit(self, texts):
+        df = np.zeros(self.dim, dtype=np.float64)
+        for text in texts:
+            df[np.unique(self.buckets(text))] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            buckets, counts = np.unique(self.buckets(text), return_counts=True)
+            vectors[i, buckets] = (1 + np.log(counts)) * self.idf[buckets]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def to_config(self):
+        return {"name": self.name, "dim": self.dim, "bigrams": self.bigrams}
+
+    def save_state(self):
+        return {"idf": self.idf}
+
+    @classmethod
+    def from_config(cls, config, state):
+        return cls(config["dim"], config["bigrams"], state["idf"])
+
+
+# Embedders by name. Another embedder needs the same methods (fit may do nothing) and a name here.
+EMBEDDERS = {HashingTfidfEmbedder.name: HashingTfidfEmbedder}
+
+
+def kmeans(vectors, n_lists, iterations=10, seed=0):
+    """Centroids of spherical k-means on normalized vectors, and the list of every vector."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        lists = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = vectors[lists == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+def example_text(example, input_keys):
+    return " ".join(str(example[key]) for key in input_keys)
+
+
+def build(examples, prefix, embedder=None, input_keys=("input",), dtype="float16", n_lists=0, seed=0):
+    """Embed the examples and write <prefix>.npy, <prefix>.ivf.npz and <prefix>.index.json.
+
+    n_lists=0 picks about sqrt(len(examples)) lists.
+    """
+    if not examples:
+        raise ValueError("No examples to index")
+    embedder = embedder or HashingTfidfEmbedder()
+    texts = [example_text(example, input_keys) for example in examples]
+    vectors = embedder.fit(texts).embed(texts)
+    n_lists = min(n_lists or max(1, int(np.sqrt(len(examples)))), len(examples))
+    centroids, lists = kmeans(vectors, n_lists, seed=seed)
+    # Rows of the same list are stored next to each other
+    order = np.argsort(lists, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(lists, minlength=n_lists))))
+    np.save(prefix + ".npy", vectors[order].astype(dtype))
+    np.savez(prefix + ".ivf.npz", centroids=centroids, order=order, offsets=offsets, **embedder.save_state())
+    with open(prefix + ".index.json", 'w') as f:
+        json.dump({"embedder": embedder.to_config(), "input_keys": list(input_keys), "count": len(examples),
+                   "dtype": dtype, "lists": n_lists}, f)
+
+
+class ExampleIndex:
+    """Examples and their prebuilt index, the matrix memory-mapped rather than read."""
+    def __init__(self, prefix, examples):
+        with open(prefix + ".index.json") as f:
+            meta = json.load(f)
+        ivf = np.load(prefix + ".ivf.npz")
+        self.examples = examples
+        self.input_keys = meta["input_keys"]
+        self.embedder = EMBEDDERS[meta["embedder"]["name"]].from_config(meta["embedder"], ivf)
+        self.vectors = np.load(prefix + ".npy", mmap_mode="r")
+        self.centroids = ivf["centroids"]
+        self.order = ivf["order"]
+        self.offsets = ivf["offsets"]
+        self.added = {}  # list -> (ids, vectors) of the examples added since the build
+
+    @classmethod
+    def load(cls, prefix, examples_path):
+        with open(examples_path) as f:
+            return cls(prefix, json.load(f))
+
+    def search(self, text, k=2, nprobe=8):
+        """Ids and cosine similarities of the k examples closest to `text`, among the nprobe closest lists."""
+        query = self.embedder.embed([text])[0]
+        nprobe = min(nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ids, scores = [], []
+        for c in probed:
+            start, end = self.offsets[c], self.offsets[c + 1]
+            ids.append(self.order[start:end])
+            scores.append(np.asarray(self.vectors[start:end], dtype=np.float32) @ query)
+            if c in self.added:
+                added_ids, added_vectors = self.added[c]
+                ids.append(np.array(added_ids, dtype=self.order.dtype))
+                scores.append(np.array(added_vectors, dtype=np.float32) @ query)
+        ids, scores = np.concatenate(ids), np.concatenate(scores).astype(np.float32)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return ids[top], scores[top]
+
+    def add(self, example):
+        """Add an example to the list of its nearest centroid, in memory only. Returns its id."""
+        vector = self.embedder.embed([example_text(example, self.input_keys)])[0]
+        c = int(np.argmax(self.centroids @ vector))
+        self.examples.append(example)
+        added_ids, added_vectors = self.added.setdefault(c, ([], []))
+        added_ids.append(len(self.examples) - 1)
+        # Stored like the built rows, so an added example scores as it will after a rebuild
+        added_vectors.append(vector.astype(self.vectors.dtype))
+        return len(self.examples) - 1
+
+    def select(self, input_variables, k=2, nprobe=8):
+        """The k examples most similar to the input, like SemanticSimilarityExampleSelector.select_examples."""
+        ids, _ = self.search(example_text(input_variables, self.input_keys), k, nprobe)
+        return [self.examples[i] for i in ids]
+
+
+def example_selector(index, k=2, nprobe=8):
+    """A langchain example selector over a prebuilt ExampleIndex, in place of SemanticSimilarityExampleSelector."""
+    from langchain_core.example_selectors import BaseExampleSelector
+
+    class IndexExampleSelector(BaseExampleSelector):
+        def add_example(self, example):
+            return index.add(example)
+
+        def select_examples(self, input_variables):
+            return index.select(input_variables, k, nprobe)
+
+    return IndexExampleSelector()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Query a prebuilt in-context example index')
+    parser.add_argument('--Prefix', default='data/ds_example', help='Prefix of the index files')
+    parser.add_argument('--Examples', default='data/ds_example.json', help='Examples the index was built from')
+    parser.add_argument('--Query', required=True, help='Question to find examples for')
+    parser.add_argument('--K', type=int, default=2, help='Number of examples')
+    parser.add_argument('--Nprobe', type=int, default=8, help='Number of index lists searched')
+    args = parser.parse_args()
+    index = ExampleIndex.load(args.Prefix, args.Examples)
+    start = time.perf_counter()
+    ids, scores = index.search(args.Query, args.K, args.Nprobe)
+    print(f"{(time.perf_counter() - start) * 1000:.1f}ms")
+    for i, score in zip(ids, scores):
+        print(f"{score:.3f} {json.dumps(index.examples[i])[:200]}")
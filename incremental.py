@@ -0,0 +1,84 @@
+'''
+This code is used to refresh an exported dataset with only the tickets that changed.
+A watermark file remembers up to when the last export read ticket updates. An
+incremental run reads only tickets with LastUpdated after it, and merge_pairs
+replaces every pair of those tickets in the JSON lines outputs with the rebuilt
+ones, keeping the pairs of all other tickets as they are.
+'''
+import datetime
+import json
+import os
+import qa_output
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Tickets updated shortly before the watermark are read again, in case RT reads dates
+# of queries in another time zone than UTC. Reading a ticket twice is harmless.
+OVERLAP = datetime.timedelta(days=1)
+
+
+def now():
+    """Current time in UTC, the time zone RT stores LastUpdated in."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime(DATE_FORMAT)
+
+
+class Watermark:
+    """Time up to which an export read ticket updates, stored as JSON."""
+    def __init__(self, path):
+        self.path = path
+        self.value = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.value = json.load(f)["LastUpdated"]
+
+    def since(self):
+        """Read tickets updated after this, None if there was no export yet."""
+        if self.value is None:
+            return None
+        return (datetime.datetime.strptime(str(self.value)[:19], DATE_FORMAT) - OVERLAP).strftime(DATE_FORMAT)
+
+    def save(self, value):
+        # Replace the file in one step, so a crash never leaves half a watermark
+        self.value = str(value)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"LastUpdated": self.value}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def ticket_number(key):
+    """Ticket number of a ticket key, e.g. "12345" for "tacc.utexas.edu #12345"."""
+    return str(key).rsplit("#", 1)[-1].strip()
+
+
+def record_ticket(record):
+    """Ticket of a JSON lines record: a pair with a ticket_id, or a compact conversation or pair."""
+    key = record.get("conversation", record.get("ticket_id"))
+    return None if key is None else ticket_number(key)
+
+
+def merge_pairs(path, pairs, changed_tickets, compact=False):
+    """Replace the pairs of `changed_tickets` in a JSON lines file with `pairs`.
+
+    Pairs of changed tickets that were dropped this time are removed. Records that do
+    not name their ticket are kept. Returns the numbers of lines kept and dropped.
+    """
+    changed = {ticket_number(ticket) for ticket in changed_tickets}
+    tmp_path = path + '.merge'
+    kept = dropped = 0
+    with open(tmp_path, 'w') as out:
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if record_ticket(json.loads(line)) in changed:
+                        dropped += 1
+                    else:
+                        out.write(line)
+                        kept += 1
+    with qa_output.JsonlWriter(tmp_path, mode='a', compact=compact) as writer:
+        writer.write_all(pairs)
+    os.replace(tmp_path, path)
+    return kept, dropped
@@ -1,38 +1,230 @@
 import rt_get_ticket
 import datetime
+import qa_output
+import os
+import run_manifest
+import dataset_split
+import incremental
 import json
-import copy
-
-def main(FromDate='2015-07-01', ToDate='2024-10-01'):
-    train_dataset, eval_dataset = [], []
-    First = 'True'
-    From = FromDate
-    To = From
-    date = datetime.date.fromisoformat(FromDate)
-    while To != ToDate:
-        date = datetime.date.fromisoformat(From)
-        date = date + datetime.timedelta(days=90)
-        To = date.strftime('%Y-%m-%d')
-        if To > ToDate:
-            To = ToDate
-        print(From, To)
-        cur_train_dataset, cur_eval_dataset = rt_get_ticket.main(FromDate=From, ToDate=To, First=First)
-        train_dataset.extend(copy.deepcopy(cur_train_dataset))
-        eval_dataset.extend(copy.deepcopy(cur_eval_dataset))
-        From = date - datetime.timedelta(days=1)
-        From = From.strftime('%Y-%m-%d')
-        First = 'False'
-        
-    with open("/data/24ds_train_ascii.json", 'w') as f:
-        json.dump(train_dataset, f)
-    with open("/data/24ds_eval_ascii.json", 'w') as f:
-        json.dump(eval_dataset, f)
-    
+from concurrent.futures import ProcessPoolExecutor
+from conversation import read_pairs
+
+def date_windows(FromDate, ToDate, days=90):
+    """Split [FromDate, ToDate) into half-open windows of at most `days` days."""
+    windows = []
+    start = datetime.date.fromisoformat(FromDate)
+    end = datetime.date.fromisoformat(ToDate)
+    while start < end:
+        stop = min(start + datetime.timedelta(days=days), end)
+        windows.append((start.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d')))
+        start = stop
+    return windows
+
+class TicketWriter:
+    """Write the pairs of each ticket to train or eval as soon as the ticket is cleaned,
+    by the ticket hash of dataset_split. Tickets in `seen_tickets` are skipped."""
+    def __init__(self, train_writer, eval_writer, eval_fraction, seed, seen_tickets=()):
+        self.train_writer = train_writer
+        self.eval_writer = eval_writer
+        self.eval_fraction = eval_fraction
+        self.seed = seed
+        self.seen_tickets = seen_tickets
+        self.tickets = set()
+
+    def __call__(self, ticket_id, pairs):
+        if ticket_id in self.seen_tickets:
+            return
+        self.tickets.add(ticket_id)
+        eval = dataset_split.is_eval(ticket_id, self.eval_fraction, self.seed)
+        (self.eval_writer if eval else self.train_writer).write_all(pairs)
+
+def run_window(window, First, options, sink, MetricsDir=None, MetricsFormat='json'):
+    """Clean the tickets of a window, giving the pairs of each to `sink`. Returns the ids of all tickets read."""
+    From, To = window
+    print(From, To)
+    MetricsPath = None
+    if MetricsDir:
+        # One metrics file per window, written when the window is done
+        os.makedirs(MetricsDir, exist_ok=True)
+        MetricsPath = os.path.join(MetricsDir, f"metrics_{From}_{To}.{'prom' if MetricsFormat == 'prometheus' else 'json'}")
+    read_tickets = set()
+    rt_get_ticket.main(FromDate=From, ToDate=To, First=First, MetricsPath=MetricsPath, ReadTickets=read_tickets,
+                       PairSink=sink, **options)
+    return read_tickets
+
+def part_paths(window, train_jsonl, eval_jsonl):
+    return [f"{path}.{window[0]}_{window[1]}.part" for path in (train_jsonl, eval_jsonl)]
+
+def run_window_to_parts(window, First, options, parts, compact, MetricsDir=None, MetricsFormat='json'):
+    """run_window for a worker process, writing the train and eval pairs of the window to
+    its own part files. Returns the ids of all tickets read."""
+    with qa_output.JsonlWriter(parts[0], mode='w', compact=compact) as train_part, \
+            qa_output.JsonlWriter(parts[1], mode='w', compact=compact) as eval_part:
+        sink = TicketWriter(train_part, eval_part, options['EvalFraction'], options['Seed'])
+        return run_window(window, First, options, sink, MetricsDir, MetricsFormat)
+
+def append_part(part, writer, seen_tickets):
+    """Copy the lines of a part file into an output, except those of tickets in `seen_tickets`,
+    and delete it. Returns the tickets copied."""
+    tickets = set()
+    with open(part) as f:
+        for line in f:
+            ticket_id = incremental.record_ticket(json.loads(line))
+            if ticket_id not in seen_tickets:
+                tickets.add(ticket_id)
+                writer.write_line(line)
+    os.remove(part)
+    return tickets
+
+def windows_in_turn(windows, firsts, options, Processes, Compact, train_jsonl, eval_jsonl, train_writer, eval_writer,
+                    seen_tickets, MetricsDir=None, MetricsFormat='json'):
+    """Yield (window, tickets written, tickets read) of every window in order, once its pairs
+    are in the writers. One process writes pairs straight into the writers, several write
+    each window to part files that are copied over in window order."""
+    if Processes == 1:
+        for window, First in zip(windows, firsts):
+            sink = TicketWriter(train_writer, eval_writer, options['EvalFraction'], options['Seed'], seen_tickets)
+            read_tickets = run_window(window, First, options, sink, MetricsDir, MetricsFormat)
+            yield window, sink.tickets, read_tickets
+        return
+    parts = [part_paths(window, train_jsonl, eval_jsonl) for window in windows]
+    with ProcessPoolExecutor(max_workers=Processes) as executor:
+        # Results come back in window order, whatever order the windows finish in
+        results = executor.map(run_window_to_parts, windows, firsts, [options] * len(windows), parts,
+                               [Compact == 'True'] * len(windows), [MetricsDir] * len(windows),
+                               [MetricsFormat] * len(windows))
+        try:
+            for window, (train_part, eval_part), read_tickets in zip(windows, parts, results):
+                tickets = append_part(train_part, train_writer, seen_tickets)
+                tickets |= append_part(eval_part, eval_writer, seen_tickets)
+                yield window, tickets, read_tickets
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+def main(FromDate='2015-07-01', ToDate='2024-10-01', QuoteMatch='index', Workers=8, Rate=10.0,
+         Cache=None, CacheSize=20, Processes=1, JsonArray='True',
+         TrainPath='/data/24ds_train_ascii.json', EvalPath='/data/24ds_eval_ascii.json', Resume='True',
+         Compact='False', EvalFraction=dataset_split.EVAL_FRACTION, Seed=0, MetricsDir=None, MetricsFormat='json',
+         Source='rest1', DatabaseUrl=rt_get_ticket.DATABASE_URL, Incremental='False'):
+    train_jsonl, eval_jsonl = TrainPath + 'l', EvalPath + 'l'
+    # Tickets updated after this run started are read again by the next incremental run
+    watermark = incremental.Watermark(TrainPath + '.watermark.json')
+    started = incremental.now()
+    options = dict(QuoteMatch=QuoteMatch, Workers=Workers, Rate=Rate / Processes,
+                   Cache=Cache, CacheSize=CacheSize, EvalFraction=EvalFraction, Seed=Seed, Source=Source,
+                   DatabaseUrl=DatabaseUrl)
+    if Incremental == 'True':
+        if watermark.since() is None:
+            print(f"No watermark at {watermark.path}, run a full export first")
+            return
+        update(FromDate, ToDate, dict(options, UpdatedSince=watermark.since()), Processes, JsonArray,
+               TrainPath, EvalPath, Compact, MetricsDir, MetricsFormat)
+        watermark.save(started)
+        return
+    # Completed windows are recorded, so an interrupted run continues where it stopped
+    manifest = run_manifest.RunManifest(TrainPath + '.manifest.json',
+                                        dict(FromDate=FromDate, ToDate=ToDate, QuoteMatch=QuoteMatch,
+                                             EvalFraction=EvalFraction, Seed=Seed),
+                                        resume=Resume == 'True', started=started)
+    offsets = manifest.offsets()
+    if any(not os.path.exists(path) or os.path.getsize(path) < offset for path, offset in offsets.items()):
+        print("Outputs are shorter than the manifest says, starting over")
+        manifest.windows = []
+        manifest.started = started
+    if manifest.resuming():
+        run_manifest.truncate_outputs(manifest.offsets())
+        print(f"Resuming after {len(manifest.windows)} completed windows")
+    mode = 'a' if manifest.resuming() else 'w'
+
+    windows = [window for window in date_windows(FromDate, ToDate) if not manifest.completed(window)]
+    firsts = ['False' if manifest.resuming() else 'True'] + ['False'] * (len(windows) - 1)
+    seen_tickets = manifest.seen_tickets()
+    # Pairs are appended to JSON lines files ticket by ticket as they are cleaned
+    # Compact files store the turns of a ticket once, instead of once per pair
+    train_writer = qa_output.JsonlWriter(train_jsonl, mode=mode, compact=Compact == 'True')
+    eval_writer = qa_output.JsonlWriter(eval_jsonl, mode=mode, compact=Compact == 'True')
+    try:
+        for window, window_tickets, _ in windows_in_turn(windows, firsts, options, Processes, Compact, train_jsonl,
+                                                         eval_jsonl, train_writer, eval_writer, seen_tickets,
+                                                         MetricsDir, MetricsFormat):
+            seen_tickets.update(window_tickets)
+            manifest.record(window, window_tickets,
+                            {train_jsonl: train_writer.offset(), eval_jsonl: eval_writer.offset()})
+    finally:
+        train_writer.close()
+        eval_writer.close()
+
+    if JsonArray == 'True':
+        qa_output.jsonl_to_json(train_jsonl, TrainPath)
+        qa_output.jsonl_to_json(eval_jsonl, EvalPath)
+    watermark.save(manifest.started)
+
+def update(FromDate, ToDate, options, Processes=1, JsonArray='True', TrainPath='/data/24ds_train_ascii.json',
+           EvalPath='/data/24ds_eval_ascii.json', Compact='False', MetricsDir=None, MetricsFormat='json'):
+    """Rebuild the pairs of the tickets updated since options['UpdatedSince'], and merge them
+    into the outputs of an earlier run in place of the old pairs of the same tickets."""
+    windows = date_windows(FromDate, ToDate)
+    # The rebuilt pairs are collected in update files first, and merged once all windows are done
+    train_update, eval_update = TrainPath + 'l.update', EvalPath + 'l.update'
+    read_tickets = set()
+    with qa_output.JsonlWriter(train_update, mode='w', compact=Compact == 'True') as train_writer, \
+            qa_output.JsonlWriter(eval_update, mode='w', compact=Compact == 'True') as eval_writer:
+        for _, _, cur_tickets in windows_in_turn(windows, ['False'] * len(windows), options, Processes, Compact,
+                                                 train_update, eval_update, train_writer, eval_writer, set(),
+                                                 MetricsDir, MetricsFormat):
+            read_tickets |= cur_tickets
+    print(f"{len(read_tickets)} tickets updated since {options['UpdatedSince']}")
+    for path, update_path, json_path in [(TrainPath + 'l', train_update, TrainPath),
+                                         (EvalPath + 'l', eval_update, EvalPath)]:
+        pairs = read_pairs(qa_output.read_jsonl(update_path), materialize=False)
+        kept, dropped = incremental.merge_pairs(path, pairs, read_tickets, compact=Compact == 'True')
+        os.remove(update_path)
+        print(f"{path}: kept {kept} lines, replaced {dropped} lines")
+        if JsonArray == 'True':
+            qa_output.jsonl_to_json(path, json_path)
+    # The outputs no longer end where the manifest of the full run says, a resumed
+    # full run would cut them there
+    if os.path.exists(TrainPath + '.manifest.json'):
+        os.remove(TrainPath + '.manifest.json')
+
 
 if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Put in date range to process')
     parser.add_argument('--FromDate', help='Earliest create date, 2020-01-01', default='2015-07-01')
     parser.add_argument('--ToDate', help='Latest create date, 2021-01-01', default='2024-10-01')
+    parser.add_argument('--QuoteMatch', choices=['index', 'substring'], default='index',
+                        help='How quoted lines are matched against earlier emails, substring reproduces the old behavior')
+    parser.add_argument('--Workers', type=int, default=8, help='Number of concurrent RT requests, 1 fetches tickets one by one')
+    parser.add_argument('--Rate', type=float, default=10.0, help='Maximum RT requests per second')
+    parser.add_argument('--Cache', help='SQLite file to cache RT responses in, e.g. /data/rt_cache.sqlite')
+    parser.add_argument('--CacheSize', type=float, default=20, help='Maximum size of the RT cache in GB')
+    parser.add_argument('--Processes', type=int, default=1, help='Number of date windows processed in parallel')
+    parser.add_argument('--JsonArray', choices=['True', 'False'], default='True',
+                        help='Also convert the JSON lines outputs into the JSON arrays DeepSpeed-Chat reads')
+    parser.add_argument('--TrainPath', default='/data/24ds_train_ascii.json', help='Train dataset, JSON lines go to <path>l')
+    parser.add_argument('--EvalPath', default='/data/24ds_eval_ascii.json', help='Eval dataset, JSON lines go to <path>l')
+    parser.add_argument('--Resume', choices=['True', 'False'], default='True',
+                        help='Continue an interrupted run from its manifest, False starts over')
+    parser.add_argument('--Compact', choices=['True', 'False'], default='False',
+                        help='Write each ticket conversation once in the JSON lines outputs, pairs refer to its turns')
+    parser.add_argument('--EvalFraction', type=float, default=dataset_split.EVAL_FRACTION,
+                        help='Share of tickets that go to the eval set')
+    parser.add_argument('--Seed', type=int, default=0, help='Seed of the ticket hash deciding the split')
+    parser.add_argument('--MetricsDir', help='Directory to write drop counters and phase timers of every window to')
+    parser.add_argument('--MetricsFormat', choices=['json', 'prometheus'], default='json',
+                        help='Format of the metrics files')
+    parser.add_argument('--Source', choices=['rest1', 'rest2', 'db'], default='rest1',
+                        help='rest2 fetches the histories of every date window in bulk through REST 2.0, '
+                             'db reads tickets and histories from the rt5 database')
+    parser.add_argument('--DatabaseUrl', default=rt_get_ticket.DATABASE_URL,
+                        help='SQLAlchemy url of the rt5 database for --Source db')
+    parser.add_argument('--Incremental', choices=['True', 'False'], default='False',
+                        help='Only rebuild tickets updated since the last run, and replace their pairs in the outputs')
     args = parser.parse_args()
-    main(FromDate=args.FromDate, ToDate=args.ToDate)
\ No newline at end of file
+    main(FromDate=args.FromDate, ToDate=args.ToDate, QuoteMatch=args.QuoteMatch, Workers=args.Workers, Rate=args.Rate,
+         Cache=args.Cache, CacheSize=args.CacheSize, Processes=args.Processes, JsonArray=args.JsonArray,
+         TrainPath=args.TrainPath, EvalPath=args.EvalPath, Resume=args.Resume, Compact=args.Compact,
+         EvalFraction=args.EvalFraction, Seed=args.Seed, MetricsDir=args.MetricsDir,
+         MetricsFormat=args.MetricsFormat, Source=args.Source,
+         DatabaseUrl=args.DatabaseUrl, Incremental=args.Incremental)
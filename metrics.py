@@ -0,0 +1,102 @@
+'''
+This code is used to count and time what rt_get_ticket does with every ticket.
+Counters tell how many tickets and emails were dropped for each reason, and timers
+keep a histogram of how long each phase (RT fetch, attachment lookup, line cleaning,
+pair building) took per ticket, so a slow run shows whether it waits on the network
+or on the regexes. Metrics are written as JSON, or as Prometheus text for .prom files.
+'''
+import bisect
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds of the timer histogram buckets, in seconds
+TIMER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Timer:
+    """Histogram of durations, with their count and sum."""
+    def __init__(self):
+        self.buckets = [0] * (len(TIMER_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(TIMER_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum,
+                "buckets": dict(zip([str(b) for b in TIMER_BUCKETS] + ["+Inf"], self.buckets))}
+
+
+class Metrics:
+    """Counters by (name, reason) and timers by phase."""
+    def __init__(self):
+        self.counters = Counter()
+        self.timers = {}
+
+    def count(self, name, reason=None, n=1):
+        self.counters[(name, reason)] += n
+
+    def observe(self, phase, seconds):
+        if phase not in self.timers:
+            self.timers[phase] = Timer()
+        self.timers[phase].observe(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def to_dict(self):
+        counters = {}
+        for (name, reason), n in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+            if reason is None:
+                counters[name] = n
+            else:
+                counters.setdefault(f"{name}_by_reason", {})[reason] = n
+        return {"counters": counters, "timers": {phase: timer.to_dict() for phase, timer in self.timers.items()}}
+
+    def to_prometheus(self, prefix="rt_get_history", labels=None):
+        """Metrics in the Prometheus text format, with `labels` (e.g. the date window) on every sample."""
+        def label_text(extra=None):
+            merged = dict(labels or {}, **(extra or {}))
+            return "{" + ",".join(f'{k}="{v}"' for k, v in merged.items()) + "}" if merged else ""
+
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter, reason), n in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+                if counter == name:
+                    lines.append(f"{prefix}_{name}_total{label_text(reason and {'reason': reason})} {n}")
+        metric = f"{prefix}_phase_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for phase, timer in self.timers.items():
+            cumulative = 0
+            for bound, n in zip([str(b) for b in TIMER_BUCKETS] + ["+Inf"], timer.buckets):
+                cumulative += n
+                lines.append(f"{metric}_bucket{label_text({'phase': phase, 'le': bound})} {cumulative}")
+            lines.append(f"{metric}_sum{label_text({'phase': phase})} {timer.sum}")
+            lines.append(f"{metric}_count{label_text({'phase': phase})} {timer.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, labels=None):
+        """Write the metrics to `path`, in Prometheus text if it ends with .prom, JSON otherwise."""
+        with open(path, 'w') as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus(labels=labels))
+            else:
+                json.dump(dict(self.to_dict(), labels=labels or {}), f, indent=1)
+
+    def summary(self):
+        """One line per phase with its total and mean time, and the drop counters."""
+        lines = [f"{phase}: {timer.sum:.2f}s over {timer.count}, {timer.sum / max(timer.count, 1) * 1000:.1f}ms each"
+                 for phase, timer in self.timers.items()]
+        lines.append(f"counters: {self.to_dict()['counters']}")
+        return "\n".join(lines)
@@ -0,0 +1,199 @@
+'''
+This code is used to serve a synthetic corpus (synthetic_rt.py) over the RT REST 1.0
+API, so rt_get_ticket and rt_fetch can be benchmarked against a local server.
+Responses follow the format the python-rt client parses: search, ticket, history,
+attachments and attachment. The transaction and attachment searches of REST 2.0
+that rt_rest2 uses are served too. An optional delay per request stands in for the
+network latency of the production RT server.
+'''
+import base64
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import synthetic_rt
+
+STATUS = "RT/4.4.3 200 Ok\n\n"
+
+
+def _field(key, value):
+    # Multi-line values continue on lines indented under the first one
+    lines = str(value).split("\n")
+    indent = " " * (len(key) + 2)
+    return f"{key}: {lines[0]}" + "".join("\n" + indent + line for line in lines[1:])
+
+
+def _size(text):
+    return f"{len(text.encode()) / 1024:.1f}k" if len(text) >= 1024 else f"{len(text.encode())}b"
+
+
+class MockRT:
+    """REST 1.0 and 2.0 responses for the tickets of a corpus."""
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.requests = 0
+        self.transaction_of = {att_id: int(item["id"]) for items in corpus.histories.values()
+                               for item in items for att_id in item["Attachments"]}
+
+    def respond(self, path, query):
+        self.requests += 1
+        path = re.sub(r"^/?(REST/1\.0/?)?", "", path)
+        if path in ("", "logout"):
+            return STATUS
+        if path == "search/ticket":
+            dates = dict(re.findall(r"Created\s*(>=|<)\s*'([\d-]+)'", query.get("query", [""])[0]))
+            tickets = self.corpus.search(dates.get(">="), dates.get("<"))
+            if not tickets:
+                return STATUS + "No matching results.\n"
+            return STATUS + "\n--\n".join("\n".join(_field(k, v) for k, v in t.items()) for t in tickets) + "\n"
+        match = re.match(r"ticket/(\d+)(/show)?$", path)
+        if match:
+            ticket = next((t for t in self.corpus.tickets if t["id"] == f"ticket/{match.group(1)}"), None)
+            if ticket is None:
+                return STATUS + f"# Ticket {match.group(1)} does not exist.\n"
+            return STATUS + "\n".join(_field(k, v) for k, v in ticket.items()) + "\n"
+        match = re.match(r"ticket/(\d+)/history$", path)
+        if match:
+            return self.history(match.group(1))
+        match = re.match(r"ticket/(\d+)/attachments$", path)
+        if match:
+            return self.attachment_list(match.group(1))
+        match = re.match(r"ticket/(\d+)/attachments/(\d+)$", path)
+        if match:
+            return self.attachment(match.group(1), int(match.group(2)))
+        return "RT/4.4.3 400 Bad Request\n\n# Unknown request\n"
+
+    def respond_rest2(self, path, query, body=None):
+        """REST 2.0 transaction and attachment searches, as JSON."""
+        self.requests += 1
+        path = re.sub(r"^/?REST/2\.0/?", "", path)
+        if path == "transactions":
+            dates = dict(re.findall(r"TicketCreated\s*(>=|<)\s*'([\d-]+)'", query.get("query", [""])[0]))
+            found = []
+            for ticket in self.corpus.search(dates.get(">="), dates.get("<")):
+                for item in self.corpus.histories[ticket["id"].split("/")[1]]:
+                    # Transactions carry the user name and values RT builds the Description from
+                    creator = item["Description"].rsplit(" by ", 1)[-1]
+                    values = re.findall(r"'([^']*)'", item["Description"]) if item["Type"] == "Status" else []
+                    found.append({"id": int(item["id"]), "type": "transaction", "Type": item["Type"],
+                                  "Creator": {"id": creator, "type": "user"}, "Created": item["Created"],
+                                  "ObjectId": int(item["Ticket"]), "TimeTaken": 0, "Field": item["Field"],
+                                  "OldValue": values[0] if values else item["OldValue"],
+                                  "NewValue": values[1] if values else item["NewValue"], "Data": item["Data"]})
+            found.sort(key=lambda t: t["id"])
+        elif path == "attachments":
+            # Only the IN searches rt_rest2 makes, on TransactionId or id
+            wanted = {f["field"]: set(f["value"]) for f in json.loads(body or "[]") if f["operator"] == "IN"}
+            fields = query.get("fields", [""])[0].split(",")
+            found = []
+            for att_id in sorted(self.corpus.attachments):
+                transaction_id = self.transaction_of[att_id]
+                if transaction_id in wanted.get("TransactionId", {transaction_id}) and att_id in wanted.get("id", {att_id}):
+                    _, name, ctype, content = self.corpus.attachments[att_id]
+                    attachment = {"id": att_id, "type": "attachment", "Parent": 0,
+                                  "TransactionId": {"id": transaction_id, "type": "transaction"},
+                                  "Filename": name, "ContentType": ctype,
+                                  "Content": base64.b64encode(content.encode()).decode()}
+                    found.append({key: value for key, value in attachment.items()
+                                  if key in ("id", "type") or key in fields})
+        else:
+            return json.dumps({"message": "Not Found"})
+        page, per_page = int(query.get("page", ["1"])[0]), int(query.get("per_page", ["20"])[0])
+        return json.dumps({"count": len(found[(page - 1) * per_page:page * per_page]), "page": page,
+                           "per_page": per_page, "pages": max(1, -(-len(found) // per_page)), "total": len(found),
+                           "items": found[(page - 1) * per_page:page * per_page]})
+
+    def history(self, ticket_id):
+        items = self.corpus.histories.get(ticket_id)
+        if items is None:
+            return STATUS + f"# Ticket {ticket_id} does not exist.\n"
+        blocks = []
+        for n, item in enumerate(items):
+            lines = [f"# {n + 1}/{len(items)} (id/{item['id']}/total)", ""]
+            for key in ["id", "Ticket", "TimeTaken", "Type", "Field", "OldValue", "NewValue", "Data",
+                        "Description"]:
+                lines.append(_field(key, item[key]))
+            lines.append(_field("Content", item["Content"]))
+            lines += [_field("Creator", item["Creator"]), _field("Created", item["Created"]), "", "Attachments:"]
+            for att_id in item["Attachments"]:
+                _, name, _, body = self.corpus.attachments[att_id]
+                lines.append(f"             {att_id}: {name or 'untitled'} ({_size(body)})")
+            blocks.append("\n".join(lines))
+        return STATUS + "\n--\n".join(blocks) + "\n"
+
+    def attachment_list(self, ticket_id):
+        if ticket_id not in self.corpus.histories:
+            return STATUS + f"# Ticket {ticket_id} does not exist.\n"
+        lines = [f"id: ticket/{ticket_id}/attachments", "Attachments:"]
+        for item in self.corpus.histories[ticket_id]:
+            for att_id in item["Attachments"]:
+                _, name, ctype, body = self.corpus.attachments[att_id]
+                lines.append(f"             {att_id}: {name or '(Unnamed)'} ({ctype} / {_size(body)}),")
+        return STATUS + "\n".join(lines) + "\n"
+
+    def attachment(self, ticket_id, att_id):
+        if att_id not in self.corpus.attachments:
+            return STATUS + f"# Invalid attachment id: {att_id}\n"
+        _, name, ctype, body = self.corpus.attachments[att_id]
+        return STATUS + "\n".join([f"id: {att_id}", "Subject: ", "Creator: 1", "Created: 2020-01-01 00:00:00",
+                                   "Transaction: 0", "Parent: 0", "MessageId: ", f"Filename: {name}",
+                                   f"ContentType: {ctype}", "ContentEncoding: none", "",
+                                   f"Headers: Content-Type: {ctype}", "", _field("Content", body)]) + "\n"
+
+
+def serve(corpus, port=0, latency=0.0):
+    """Start a mock RT server in a background thread. Returns (server, REST url)."""
+    mock = MockRT(corpus)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self):
+            if latency:
+                time.sleep(latency)
+            url = urlparse(self.path)
+            if "/REST/2.0/" in url.path:
+                body = mock.respond_rest2(url.path, parse_qs(url.query), self.body).encode("utf-8")
+                content_type = "application/json"
+            else:
+                body = mock.respond(url.path, parse_qs(url.query)).encode("utf-8")
+                content_type = "text/plain; charset=utf-8"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.body = None
+            self._reply()
+
+        def do_POST(self):
+            self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._reply()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/REST/1.0/"
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve synthetic RT tickets over the REST 1.0 API')
+    parser.add_argument('--Tickets', type=int, default=1000, help='Number of tickets')
+    parser.add_argument('--Seed', type=int, default=0, help='Seed of the generator')
+    parser.add_argument('--Port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--Latency', type=float, default=0.0, help='Seconds to wait before every response')
+    args = parser.parse_args()
+    server, url = serve(synthetic_rt.Corpus(args.Tickets, seed=args.Seed), args.Port, args.Latency)
+    print(f"Serving {args.Tickets} tickets at {url}, set RT_HOST to it")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,174 @@
+'''
+This code is used to remove near-duplicate QA pairs across the whole dataset.
+Many tickets get almost the same canned answers and questions. Every pair is reduced
+to a MinHash signature of the word shingles of its text, and the signature is cut
+into bands. Pairs that share a band are candidates, and a candidate is a near
+duplicate when the signatures agree on at least `threshold` of their hashes, which
+estimates the Jaccard similarity of the shingles. Pairs are read in one pass, each
+compared only with the pairs in the buckets of its bands, and at most `keep` pairs
+of every cluster of near duplicates are kept. Only kept pairs are indexed, so memory
+grows with the deduplicated dataset. By default only the last turn of a prompt is
+compared, as later pairs of a ticket repeat its whole history in their prompts, and
+pairs known to be of the same ticket are never compared with each other.
+'''
+import json
+import re
+import zlib
+import numpy as np
+import qa_output
+from conversation import Pair, read_pairs
+
+WORD_RE = re.compile(r"\w+")
+# Start of a turn's text in a prompt, in the rt and the db style
+TURN_RE = re.compile(r"(?:^|\s)(?:Human|Assistant): ")
+PROMPT_SUFFIX = "Assistant:"
+
+
+def ticket_of(pair):
+    """Ticket of a pair, None when the pair does not tell."""
+    if isinstance(pair, Pair):
+        return pair.conversation.key()
+    return pair.get("ticket_id")
+
+
+def last_turn(pair):
+    """Text of the turn a pair answers, the end of its prompt."""
+    if isinstance(pair, Pair):
+        return pair.conversation.turns[pair.turn - 1][1] if pair.turn > pair.start else ""
+    prompt = pair["prompt"].rstrip()
+    if prompt.endswith(PROMPT_SUFFIX):
+        prompt = prompt[:-len(PROMPT_SUFFIX)].rstrip()
+    starts = [match.end() for match in TURN_RE.finditer(prompt)]
+    return prompt[starts[-1]:] if starts else prompt
+
+
+class MinHasher:
+    """MinHash signatures of word shingles with `num_perm` hash functions."""
+    def __init__(self, num_perm=64, shingle=3, seed=0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle = shingle
+        # Odd multipliers, as multiply-shift hashing needs
+        self.a = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self.powers = np.array([pow(1000003, i, 1 << 64) for i in range(shingle)], dtype=np.uint64)
+
+    def shingles(self, text):
+        """64 bit hashes of the consecutive `shingle` word groups of the text."""
+        words = np.array([zlib.crc32(word.encode()) for word in WORD_RE.findall(text.lower())], dtype=np.uint64)
+        if len(words) == 0:
+            return np.zeros(1, dtype=np.uint64)
+        n = min(self.shingle, len(words))
+        windows = np.lib.stride_tricks.sliding_window_view(words, n)
+        return np.unique((windows * self.powers[:n]).sum(axis=1, dtype=np.uint64))
+
+    def signature(self, text):
+        hashes = self.shingles(text)
+        return ((hashes[:, None] * self.a + self.b) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+
+
+class NearDuplicates:
+    """Streaming LSH over MinHash signatures, keeping `keep` pairs of every cluster."""
+    def __init__(self, fields=("prompt", "chosen"), keep=1, threshold=0.8, num_perm=64, bands=16,
+                 shingle=3, seed=0, whole_prompt=False):
+        if num_perm % bands:
+            raise ValueError(f"num_perm {num_perm} is not a multiple of bands {bands}")
+        self.hasher = MinHasher(num_perm, shingle, seed)
+        self.fields = fields
+        self.whole_prompt = whole_prompt
+        self.keep = keep
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [{} for _ in range(bands)]  # band hash -> clusters
+        self.signatures = []                       # first signature of every cluster
+        self.tickets = []                          # ticket of every cluster's first pair
+        self.kept = []                             # number of pairs kept in every cluster
+        self.dropped = 0
+
+    def text(self, pair):
+        return "\n".join(last_turn(pair) if field == "prompt" and not self.whole_prompt else str(pair[field])
+                         for field in self.fields)
+
+    def add(self, pair):
+        """True when the pair is kept."""
+        signature = self.hasher.signature(self.text(pair))
+        ticket = ticket_of(pair)
+        keys = [hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        checked = set()
+        for band, key in enumerate(keys):
+            for cluster in self.buckets[band].get(key, ()):
+                if cluster in checked:
+                    continue
+                checked.add(cluster)
+                if ticket is not None and self.tickets[cluster] == ticket:
+                    continue
+                if np.mean(self.signatures[cluster] == signature) >= self.threshold:
+                    if self.kept[cluster] >= self.keep:
+                        self.dropped += 1
+                        return False
+                    self.kept[cluster] += 1
+                    return True
+        cluster = len(self.signatures)
+        self.signatures.append(signature)
+        self.tickets.append(ticket)
+        self.kept.append(1)
+        for band, key in enumerate(keys):
+            self.buckets[band].setdefault(key, []).append(cluster)
+        return True
+
+    def filter(self, pairs):
+        """Yield the pairs that are kept, in their order."""
+        for pair in pairs:
+            if self.add(pair):
+                yield pair
+
+    def report(self):
+        clusters = np.array(self.kept)
+        print(f"# pairs kept: {int(clusters.sum())}, near duplicates dropped: {self.dropped}, "
+              f"clusters: {len(clusters)}, with more than one pair: {int((clusters > 1).sum())}")
+
+
+def read_input(path):
+    """Pairs of a JSON lines file one by one, compact ones as Pairs, or of a JSON array file."""
+    if path.endswith(".jsonl"):
+        yield from read_pairs(qa_output.read_jsonl(path), materialize=False)
+        return
+    with open(path) as f:
+        yield from json.load(f)
+
+
+def main(Input, Output, Fields=("prompt", "chosen"), Keep=1, Threshold=0.8, NumPerm=64, Bands=16, Shingle=3,
+         Seed=0, WholePrompt='False'):
+    dedup = NearDuplicates(Fields, Keep, Threshold, NumPerm, Bands, Shingle, Seed, WholePrompt == 'True')
+    kept = dedup.filter(read_input(Input))
+    if Output.endswith(".jsonl"):
+        # Compact pairs stay compact
+        with qa_output.JsonlWriter(Output, mode='w', compact=True) as writer:
+            writer.write_all(kept)
+    else:
+        qa_output.write_json(kept, Output)
+    dedup.report()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Remove near-duplicate QA pairs with MinHash LSH')
+    parser.add_argument('--Input', required=True,
+                        help='Pairs to deduplicate, a .json array or a .jsonl file, which is streamed')
+    parser.add_argument('--Output', required=True, help='Kept pairs, a .json array or a .jsonl file')
+    parser.add_argument('--Fields', nargs='+', default=['prompt', 'chosen'], help='Fields of a pair compared')
+    parser.add_argument('--Keep', type=int, default=1, help='Number of pairs kept of every cluster of near duplicates')
+    parser.add_argument('--Threshold', type=float, default=0.8,
+                        help='Estimated Jaccard similarity of the shingles above which pairs are near duplicates')
+    parser.add_argument('--NumPerm', type=int, default=64, help='Number of MinHash functions')
+    parser.add_argument('--Bands', type=int, default=16,
+                        help='Number of LSH bands, more bands find pairs of lower similarity as candidates')
+    parser.add_argument('--Shingle', type=int, default=3, help='Number of words in a shingle')
+    parser.add_argument('--Seed', type=int, default=0, help='Seed of the hash functions')
+    parser.add_argument('--WholePrompt', choices=['True', 'False'], default='False',
+                        help='Compare the whole prompt rather than its last turn, only safe when every pair '
+                             'names its ticket, as pairs of one ticket share their history')
+    args = parser.parse_args()
+    main(Input=args.Input, Output=args.Output, Fields=args.Fields, Keep=args.Keep, Threshold=args.Threshold,
+         NumPerm=args.NumPerm, Bands=args.Bands, Shingle=args.Shingle, Seed=args.Seed, WholePrompt=args.WholePrompt)
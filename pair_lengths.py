@@ -0,0 +1,185 @@
+'''
+This code is used to measure, truncate and bucket QA pairs before finetuning.
+The length of every pair is counted in characters, or in tokens with a local
+tokenizer, a batch of pairs at a time. Prompts longer than a limit lose their
+oldest turns, so history is only cut at turn boundaries. Pairs are then written
+into shards by total length with a histogram of the buckets, so training batches
+can be packed from pairs of similar length instead of padding short ones.
+Pairs of compact JSON lines files (launch_rt --Compact True) know their turns, the
+prompts of other pairs are split into turns where a "Human: " or "Assistant: " turn
+starts, in the rt or the db style.
+'''
+import json
+import re
+import numpy as np
+import qa_output
+from conversation import Pair, read_pairs, RT_STYLE, DB_STYLE
+
+DEFAULT_BUCKETS = [512, 1024, 2048, 4096]
+# Where a turn starts in a prompt: at the start of a line in the rt style, at a space in the db style
+RT_TURN_RE = re.compile(r"(?:^|(?<=\n))(?:Human|Assistant): ")
+DB_TURN_RE = re.compile(r" (?:Human|Assistant): ")
+
+
+def load_tokenizer(path):
+    """Tokenizer of a model saved at `path`, nothing is downloaded."""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(path, local_files_only=True)
+
+
+def count(texts, tokenizer=None):
+    """Lengths of `texts` in characters, or in tokens of `tokenizer`, as an array."""
+    if tokenizer is None:
+        return np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    input_ids = tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+    return np.fromiter(map(len, input_ids), dtype=np.int64, count=len(texts))
+
+
+def pair_lengths(pairs, tokenizer=None, batch_size=10000):
+    """(prompt lengths, chosen lengths) of the pairs, counted a batch at a time."""
+    prompts, chosens = [], []
+    for i in range(0, len(pairs), batch_size):
+        batch = pairs[i:i + batch_size]
+        prompts.append(count([pair["prompt"] for pair in batch], tokenizer))
+        chosens.append(count([pair["chosen"] for pair in batch], tokenizer))
+    if not prompts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(prompts), np.concatenate(chosens)
+
+
+def _turn_ends(conversation, tokenizer, memo):
+    # Where every turn of the conversation ends, in characters or tokens, and the
+    # length of the prompt suffix. Token counts of turns are added up, which can be
+    # a token or so off from tokenizing the prompt as a whole.
+    key = id(conversation)
+    if key not in memo:
+        if tokenizer is None:
+            ends = np.asarray(conversation.ends())
+            suffix = len(conversation.style.prompt_suffix)
+        else:
+            turns = [conversation.style.turn_format.format(speaker, text) for speaker, text in conversation.turns]
+            ends = np.concatenate(([0], np.cumsum(count(turns, tokenizer))))
+            suffix = int(count([conversation.style.prompt_suffix], tokenizer)[0])
+        memo[key] = (ends, suffix)
+    return memo[key]
+
+
+def prompt_turns(prompt):
+    """The turns of a plain pair's prompt as written, and its suffix, None if it is in neither style."""
+    style, turn_re = (DB_STYLE, DB_TURN_RE) if prompt.startswith(" ") else (RT_STYLE, RT_TURN_RE)
+    if not prompt.endswith(style.prompt_suffix):
+        return None
+    text = prompt[:-len(style.prompt_suffix)]
+    starts = [match.start() for match in turn_re.finditer(text)]
+    if not starts or starts[0] != 0:
+        return None
+    return [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])], style.prompt_suffix
+
+
+def _truncate_prompt(pair, max_prompt, tokenizer):
+    # Cut a plain pair's prompt like a Pair's. False if it has no turns to cut.
+    parsed = prompt_turns(pair["prompt"])
+    if parsed is None:
+        return False
+    turns, suffix = parsed
+    ends = np.concatenate(([0], np.cumsum(count(turns, tokenizer))))
+    suffix_length = int(count([suffix], tokenizer)[0])
+    start = int(np.searchsorted(ends, ends[-1] + suffix_length - max_prompt, side='left'))
+    pair["prompt"] = "".join(turns[start:]) + suffix
+    return True
+
+
+def truncate_history(pairs, max_prompt, tokenizer=None):
+    """Drop the oldest turns of every prompt longer than `max_prompt`. Returns how many
+    prompts were cut, and how many were too long but could not be (no turns found)."""
+    memo = {}
+    cut, not_truncatable = 0, 0
+    for pair in pairs:
+        if not isinstance(pair, Pair):
+            if count([pair["prompt"]], tokenizer)[0] <= max_prompt:
+                continue
+            if _truncate_prompt(pair, max_prompt, tokenizer):
+                cut += 1
+            else:
+                not_truncatable += 1
+            continue
+        ends, suffix = _turn_ends(pair.conversation, tokenizer, memo)
+        end = ends[pair.turn]
+        if end - ends[pair.start] + suffix <= max_prompt:
+            continue
+        # First turn from which the prompt fits, at worst no history at all
+        start = int(np.searchsorted(ends[:pair.turn + 1], end + suffix - max_prompt, side='left'))
+        pair.start = max(pair.start, min(start, pair.turn))
+        cut += 1
+    return cut, not_truncatable
+
+
+def bucket_ids(lengths, buckets):
+    """Index of the smallest bucket each length fits in, len(buckets) for longer ones."""
+    return np.searchsorted(np.asarray(buckets), lengths, side='left')
+
+
+def bucket_name(buckets, i):
+    return str(buckets[i]) if i < len(buckets) else "over"
+
+
+def report(lengths, ids, buckets, unit):
+    print(f"# pairs: {len(lengths)}, {unit} per pair: mean {lengths.mean() if len(lengths) else 0:.0f}, "
+          f"p50/p90/p99/max {np.percentile(lengths, [50, 90, 99, 100]).astype(int).tolist() if len(lengths) else []}")
+    counts = np.bincount(ids, minlength=len(buckets) + 1)
+    for i, n in enumerate(counts):
+        in_bucket = lengths[ids == i]
+        padding = 1 - in_bucket.mean() / buckets[i] if n and i < len(buckets) else 0
+        bar = "#" * int(50 * n / max(counts.max(), 1))
+        print(f"<= {bucket_name(buckets, i):>6}: {n:>8} ({n / max(len(lengths), 1):6.1%}) "
+              f"padding {padding:5.1%} {bar}")
+
+
+def write_shards(pairs, ids, buckets, output_prefix):
+    """Write the pairs of every bucket into <output_prefix>_<bucket>.json, in their order."""
+    paths = []
+    for i in range(len(buckets) + 1):
+        members = np.flatnonzero(ids == i)
+        if len(members) == 0:
+            continue
+        paths.append(f"{output_prefix}_{bucket_name(buckets, i)}.json")
+        qa_output.write_json((pairs[j] for j in members), paths[-1])
+    return paths
+
+
+def read_input(path):
+    """Pairs of a JSON array file, or of a JSON lines file kept as Pairs when compact."""
+    if path.endswith(".jsonl"):
+        return list(read_pairs(qa_output.read_jsonl(path), materialize=False))
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(Input, OutputPrefix, MaxPrompt=None, Buckets=DEFAULT_BUCKETS, Tokenizer=None, BatchSize=10000):
+    tokenizer = load_tokenizer(Tokenizer) if Tokenizer else None
+    unit = "tokens" if tokenizer else "characters"
+    pairs = read_input(Input)
+    if MaxPrompt:
+        cut, not_truncatable = truncate_history(pairs, MaxPrompt, tokenizer)
+        print(f"# prompts truncated to {MaxPrompt} {unit}: {cut}, too long without turns to cut: {not_truncatable}")
+    prompt_lengths, chosen_lengths = pair_lengths(pairs, tokenizer, BatchSize)
+    lengths = prompt_lengths + chosen_lengths
+    ids = bucket_ids(lengths, Buckets)
+    report(lengths, ids, Buckets, unit)
+    for path in write_shards(pairs, ids, Buckets, OutputPrefix):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure, truncate and bucket QA pairs by length')
+    parser.add_argument('--Input', required=True, help='Pairs to process, a .json array or a .jsonl file')
+    parser.add_argument('--OutputPrefix', required=True, help='Shards are written to <prefix>_<bucket>.json')
+    parser.add_argument('--MaxPrompt', type=int, help='Longest prompt kept, older turns are cut from longer ones')
+    parser.add_argument('--Buckets', type=int, nargs='+', default=DEFAULT_BUCKETS,
+                        help='Upper lengths of the buckets, in increasing order')
+    parser.add_argument('--Tokenizer', help='Directory of a local tokenizer to count tokens instead of characters')
+    parser.add_argument('--BatchSize', type=int, default=10000, help='Number of pairs measured at a time')
+    args = parser.parse_args()
+    main(Input=args.Input, OutputPrefix=args.OutputPrefix, MaxPrompt=args.MaxPrompt, Buckets=args.Buckets,
+         Tokenizer=args.Tokenizer, BatchSize=args.BatchSize)
@@ -0,0 +1,100 @@
+'''
+This code is used to write QA pairs out as they are produced.
+Pairs are appended to JSON lines files through a small buffer that is flushed
+every few pairs or seconds, so memory does not grow with the dataset and a crash
+only loses the last unflushed pairs. DeepSpeed-Chat reads a single JSON array,
+which jsonl_to_json builds from the lines file at the end, one pair at a time.
+In compact mode, pairs that share a Conversation store its turns only once.
+'''
+import json
+import os
+import time
+from conversation import Pair, read_pairs
+
+
+class JsonlWriter:
+    """Append QA pairs to a JSON lines file."""
+    def __init__(self, path, mode='a', buffer_pairs=1000, flush_seconds=30, compact=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.f = open(path, mode)
+        self.buffer = []
+        self.buffer_pairs = buffer_pairs
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.monotonic()
+        self.count = 0
+        self.compact = compact
+        self.conversations = set()
+
+    def write(self, pair):
+        if self.compact and isinstance(pair, Pair):
+            conversation = pair.conversation
+            if conversation.key() not in self.conversations:
+                self.conversations.add(conversation.key())
+                self.buffer.append(json.dumps(conversation.to_record()) + '\n')
+            self.buffer.append(json.dumps(pair.to_ref()) + '\n')
+        else:
+            self.buffer.append(json.dumps(dict(pair)) + '\n')
+        self.count += 1
+        self._flush_if_due()
+
+    def write_line(self, line):
+        """Append a line of another JSON lines file as it is, e.g. of a file a worker process wrote."""
+        self.buffer.append(line if line.endswith('\n') else line + '\n')
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if len(self.buffer) >= self.buffer_pairs or \
+            time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def write_all(self, pairs):
+        for pair in pairs:
+            self.write(pair)
+
+    def flush(self):
+        self.f.write(''.join(self.buffer))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def offset(self):
+        """Flush, then return the size of the file, e.g. to resume from later."""
+        self.flush()
+        return self.f.tell()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_jsonl(path):
+    """Yield the records of a JSON lines file one by one."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_json(pairs, json_path):
+    """Write pairs as one JSON array, building each pair only when it is written."""
+    with open(json_path, 'w') as f:
+        f.write('[')
+        for i, pair in enumerate(pairs):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(dict(pair)))
+        f.write(']')
+
+
+def jsonl_to_json(jsonl_path, json_path):
+    """Convert a JSON lines file, compact or not, into the JSON array DeepSpeed-Chat expects, without loading it whole."""
+    write_json(read_pairs(read_jsonl(jsonl_path)), json_path)
@@ -0,0 +1,157 @@
+'''
+This code is used to keep RT REST responses on local disk between runs.
+Tickets, histories and attachments are stored in a SQLite file keyed by ticket id
+and attachment id, together with the ticket's LastUpdated. A response is only
+reused while the ticket's LastUpdated is unchanged, so rerunning the pipeline
+after changing a cleaning rule fetches nothing but the tickets changed since.
+When the file grows over its size limit, the least recently used responses go first.
+The size of the file is kept in the file too, so processes sharing it keep to one limit.
+'''
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+
+class RTCache:
+    """SQLite store of RT client responses."""
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                kind TEXT NOT NULL,
+                ticket_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                last_updated TEXT,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (kind, ticket_id, item_id)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        # Bytes of all responses, updated with every write by every process
+        self.conn.execute("CREATE TABLE IF NOT EXISTS total (bytes INTEGER NOT NULL)")
+        self.conn.execute("BEGIN IMMEDIATE")
+        if self.conn.execute("SELECT COUNT(*) FROM total").fetchone()[0] == 0:
+            self.conn.execute("INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM responses")
+        self.conn.commit()
+        self.hits, self.misses = 0, 0
+
+    def get(self, kind, ticket_id, item_id, last_updated):
+        """Return (True, response) if a response for this LastUpdated is stored, else (False, None)."""
+        with self.lock:
+            if last_updated is None:
+                self.misses += 1
+                return False, None
+            row = self.conn.execute(
+                "SELECT body FROM responses WHERE kind = ? AND ticket_id = ? AND item_id = ? AND last_updated = ?",
+                (kind, str(ticket_id), str(item_id), last_updated)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.conn.execute(
+                "UPDATE responses SET accessed = ? WHERE kind = ? AND ticket_id = ? AND item_id = ?",
+                (time.time(), kind, str(ticket_id), str(item_id)))
+            self.conn.commit()
+            self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def put(self, kind, ticket_id, item_id, last_updated, response):
+        if last_updated is None:
+            return
+        body = pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+        key = (kind, str(ticket_id), str(item_id))
+        with self.lock:
+            # One write transaction at a time across processes, so the total stays exact
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.conn.execute(
+                    "SELECT size FROM responses WHERE kind = ? AND ticket_id = ? AND item_id = ?", key).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    key + (last_updated, body, len(body), time.time()))
+                self.conn.execute("UPDATE total SET bytes = bytes + ?", (len(body) - (old[0] if old else 0),))
+                if self.conn.execute("SELECT bytes FROM total").fetchone()[0] > self.max_bytes:
+                    self._evict()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute("SELECT bytes FROM total").fetchone()[0]
+
+    def _evict(self):
+        # Drop least recently used responses until 90% of the limit is left,
+        # counting from the stored sizes rather than the running total
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT kind, ticket_id, item_id, size FROM responses ORDER BY accessed")
+        evicted = []
+        for kind, ticket_id, item_id, size in rows:
+            if total <= target:
+                break
+            evicted.append((kind, ticket_id, item_id))
+            total -= size
+        self.conn.executemany(
+            "DELETE FROM responses WHERE kind = ? AND ticket_id = ? AND item_id = ?", evicted)
+        self.conn.execute("UPDATE total SET bytes = ?", (total,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CachedClient:
+    """Wrap an rt.Rt client so its ticket, history and attachment calls go through an RTCache.
+
+    `last_updated` maps ticket ids to the LastUpdated of the ticket, as returned
+    by the search that listed them. Tickets without it are always fetched.
+    """
+    def __init__(self, client, cache, last_updated):
+        self.client = client
+        self.cache = cache
+        self.last_updated = last_updated
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def wrap(self, client):
+        """Cache the calls of another client, e.g. one per fetching thread, in the same store."""
+        return CachedClient(client, self.cache, self.last_updated)
+
+    def _cached(self, kind, ticket_id, item_id, fetch):
+        last_updated = self.last_updated.get(str(ticket_id))
+        found, response = self.cache.get(kind, ticket_id, item_id, last_updated)
+        if not found:
+            response = fetch()
+            self.cache.put(kind, ticket_id, item_id, last_updated, response)
+        return response
+
+    def get_ticket(self, ticket_id):
+        return self._cached("ticket", ticket_id, "", lambda: self.client.get_ticket(ticket_id))
+
+    def get_history(self, ticket_id):
+        return self._cached("history", ticket_id, "", lambda: self.client.get_history(ticket_id))
+
+    def get_attachments(self, ticket_id):
+        return self._cached("attachments", ticket_id, "", lambda: self.client.get_attachments(ticket_id))
+
+    def get_attachment(self, ticket_id, attachment_id):
+        return self._cached("attachment", ticket_id, attachment_id,
+                            lambda: self.client.get_attachment(ticket_id, attachment_id))
+
+
+def last_updated_of(batch_of_tickets):
+    """Map ticket ids of RT search results to their LastUpdated."""
+    return {ticket['id'].split("/")[1]: ticket.get('LastUpdated') for ticket in batch_of_tickets}
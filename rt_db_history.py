@@ -0,0 +1,121 @@
+'''
+This code is used to read ticket histories straight from the rt5 database, as a source
+of rt_get_ticket.get_history instead of the rate limited RT REST API. The tickets of a
+date window and the transactions and attachments of all of them are read with one
+streamed query each, and turned into the history items REST 1.0 get_history returns,
+so a full export gets the REST cleaning (speakers, rtbot users, [Reply from] proxies,
+quoted text) at database speed.
+'''
+import base64
+import quopri
+from sqlalchemy.sql import text
+import db_reader
+from rt_rest2 import history_item
+
+# Tickets the REST search returns for a queue and date window, merged tickets excluded
+TICKET_QUERY = """
+SELECT e.id, q.Name AS Queue, e.Subject, e.Status, e.Created, e.LastUpdated
+FROM Tickets e
+JOIN Queues q ON q.id = e.Queue
+WHERE e.id = e.EffectiveId AND q.Name = :queue AND e.Created >= :from_date AND e.Created < :to_date{updated}
+ORDER BY e.id
+"""
+
+# Transactions of those tickets and of the tickets merged into them, with their attachments.
+# Only unnamed text/plain parts can be an email's content, the Content of files is not read.
+HISTORY_QUERY = """
+SELECT e.id AS TicketId, t.id, t.ObjectId, t.Type, t.Field, t.OldValue, t.NewValue, t.Data, t.TimeTaken,
+       t.Created, u.Name AS Creator, a.id AS AttachmentId, a.Filename, a.ContentType, a.ContentEncoding,
+       CASE WHEN (a.Filename IS NULL OR a.Filename = '') AND a.ContentType LIKE 'text/plain%'
+            THEN a.Content END AS Content
+FROM Tickets e
+JOIN Queues q ON q.id = e.Queue
+JOIN Tickets k ON k.EffectiveId = e.id
+JOIN Transactions t ON t.ObjectType = 'RT::Ticket' AND t.ObjectId = k.id
+LEFT JOIN Users u ON u.id = t.Creator
+LEFT JOIN Attachments a ON a.TransactionId = t.id
+WHERE e.id = e.EffectiveId AND q.Name = :queue AND e.Created >= :from_date AND e.Created < :to_date{updated}
+ORDER BY e.id, t.Created, t.id, a.id
+"""
+
+# Only tickets updated after :updated_since, in incremental runs
+UPDATED_FILTER = "\n  AND e.LastUpdated > :updated_since"
+
+
+def _window_query(query, queue, from_date, to_date, updated_since):
+    params = {"queue": queue, "from_date": from_date, "to_date": to_date}
+    if updated_since:
+        params["updated_since"] = updated_since
+    return text(query.format(updated=UPDATED_FILTER if updated_since else "")), params
+
+
+def decode_content(attachment):
+    """Text of an attachment's Content, undoing RT's ContentEncoding."""
+    content = attachment.get("Content") or b""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    encoding = (attachment.get("ContentEncoding") or "none").lower()
+    if encoding == "base64":
+        content = base64.b64decode(content)
+    elif encoding == "quoted-printable":
+        content = quopri.decodestring(content)
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        return content.decode("latin-1")
+
+
+def search_tickets(engine, queue, from_date, to_date, updated_since=None):
+    """Tickets of `queue` created in [from_date, to_date), and updated after `updated_since`
+    if given, shaped like REST 1.0 search results."""
+    query, params = _window_query(TICKET_QUERY, queue, from_date, to_date, updated_since)
+    with engine.connect() as conn:
+        rows = conn.execute(query, params).mappings().all()
+    return [dict(row, id=f"ticket/{row['id']}", Created=str(row["Created"]), LastUpdated=str(row["LastUpdated"]))
+            for row in rows]
+
+
+def iter_histories(engine, queue, from_date, to_date, updated_since=None, chunksize=db_reader.DEFAULT_CHUNKSIZE):
+    """Yield (ticket id, history items, {attachment id: filename}) of every ticket
+    search_tickets returns for the same window, in ticket id order."""
+    query, params = _window_query(HISTORY_QUERY, queue, from_date, to_date, updated_since)
+    ticket_id, items, names = None, [], {}
+    transaction, attachments = None, []
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for row in conn.execute(query, params).mappings():
+            if transaction is not None and row["id"] != transaction["id"]:
+                items.append(history_item(transaction, attachments, names, decode_content))
+                transaction, attachments = None, []
+            if row["TicketId"] != ticket_id:
+                if ticket_id is not None:
+                    yield str(ticket_id), items, names
+                ticket_id, items, names = row["TicketId"], [], {}
+            if transaction is None:
+                transaction = dict(row)
+            if row["AttachmentId"] is not None:
+                attachments.append({"id": row["AttachmentId"], "Filename": row["Filename"],
+                                    "ContentType": row["ContentType"], "ContentEncoding": row["ContentEncoding"],
+                                    "Content": row["Content"]})
+        if transaction is not None:
+            items.append(history_item(transaction, attachments, names, decode_content))
+            yield str(ticket_id), items, names
+
+
+def ticket_histories(engine, tickets, queue, from_date, to_date, updated_since=None,
+                     chunksize=db_reader.DEFAULT_CHUNKSIZE):
+    """Yield (history items, attachment names) for each of `tickets`, in their order.
+    Tickets must come from search_tickets for the same window, in ticket id order."""
+    histories = iter_histories(engine, queue, from_date, to_date, updated_since, chunksize)
+    next_history = next(histories, None)
+    for ticket in tickets:
+        ticket_id = int(ticket["id"].split("/")[1])
+        # Tickets can change between the two queries, so skip histories of tickets
+        # the search did not return instead of waiting for them
+        while next_history is not None and int(next_history[0]) < ticket_id:
+            next_history = next(histories, None)
+        if next_history is not None and int(next_history[0]) == ticket_id:
+            yield next_history[1], next_history[2]
+            next_history = next(histories, None)
+        else:
+            yield [], {}
@@ -0,0 +1,105 @@
+'''
+This code is used to fetch ticket histories and attachments from RT concurrently.
+Requests run on a pool of threads, each with its own RT client, with a bounded
+number of tickets in flight and a rate limit per RT host. Results are returned
+in the order of the ticket ids, so the QA pairs built from them stay the same.
+'''
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from tup_services import settings
+import rt_get_ticket
+
+
+class RateLimiter:
+    """Allow at most `rate` requests per second, shared by all threads."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(host, rate):
+    """One limiter per RT host, so every fetcher talking to it shares the budget."""
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(rate)
+        return _limiters[host]
+
+
+class RateLimitedClient:
+    """Wrap an rt.Rt client so every REST call waits for the host's rate limiter."""
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not name.startswith("get_"):
+            return attr
+        def limited(*args, **kwargs):
+            self.limiter.wait()
+            return attr(*args, **kwargs)
+        return limited
+
+
+def fetch_tickets(ticket_ids, max_workers=8, rate=10.0, max_in_flight=None, wrap_client=None, attachment_memo=None):
+    """Yield (ticket_history, attachment_names) for every ticket id, in order.
+
+    At most `max_in_flight` tickets (default 2 * max_workers) are fetched or waiting
+    to be consumed at a time, so memory does not grow with the number of tickets.
+    `wrap_client`, e.g. rt_cache.CachedClient.wrap, is applied to every thread's client.
+    `attachment_memo` is passed on to rt_get_ticket.fetch_attachment_names.
+    """
+    limiter = get_limiter(urlparse(settings.RT_HOST).netloc, rate)
+    max_in_flight = max_in_flight or 2 * max_workers
+    local = threading.local()
+    clients = []
+    clients_lock = threading.Lock()
+
+    def thread_client():
+        if not hasattr(local, "client"):
+            local.client = RateLimitedClient(rt_get_ticket.get_tickets_client(), limiter)
+            if wrap_client is not None:
+                local.client = wrap_client(local.client)
+            with clients_lock:
+                clients.append(local.client)
+        return local.client
+
+    def fetch(ticket_id):
+        client = thread_client()
+        ticket_history = rt_get_ticket.fetch_ticket_history(ticket_id, client)
+        attachment_names = rt_get_ticket.fetch_attachment_names(ticket_id, ticket_history, client, attachment_memo)
+        return ticket_history, attachment_names
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for ticket_id in ticket_ids:
+                    pending.append(executor.submit(fetch, ticket_id))
+                    if len(pending) >= max_in_flight:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Stopped early, do not fetch tickets nobody will consume
+                for future in pending:
+                    future.cancel()
+    finally:
+        for client in clients:
+            client.logout()
@@ -0,0 +1,62 @@
+'''
+This code is used to resume long launch_rt runs after an interruption.
+After every completed date window, the manifest records the window, the ids of
+the tickets written for it and the sizes of the output files at that point.
+On resume, outputs are truncated back to the last recorded sizes, which drops
+pairs of a window that was cut off halfway, and completed windows are skipped.
+'''
+import json
+import os
+
+
+class RunManifest:
+    """Completed windows of a run, stored as JSON next to its outputs."""
+    def __init__(self, path, params, resume=True, started=None):
+        self.path = path
+        self.params = params
+        self.windows = []
+        # When the run began, a resumed run keeps the time of its first start
+        self.started = started
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["params"] == params:
+                self.windows = saved["windows"]
+                self.started = saved.get("started", started)
+            else:
+                print(f"Manifest {path} is from a run with other parameters, starting over")
+
+    def resuming(self):
+        return len(self.windows) > 0
+
+    def completed(self, window):
+        return any((w["From"], w["To"]) == tuple(window) for w in self.windows)
+
+    def seen_tickets(self):
+        return {ticket_id for w in self.windows for ticket_id in w["tickets"]}
+
+    def offsets(self):
+        """Sizes of the output files after the last completed window, by file path."""
+        return self.windows[-1]["offsets"] if self.windows else {}
+
+    def record(self, window, ticket_ids, offsets):
+        self.windows.append({"From": window[0], "To": window[1],
+                             "tickets": sorted(ticket_ids), "offsets": offsets})
+        self.save()
+
+    def save(self):
+        # Replace the file in one step, so a crash never leaves half a manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"params": self.params, "started": self.started, "windows": self.windows}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def truncate_outputs(offsets):
+    """Cut every output file back to its recorded size, dropping pairs written after it."""
+    for path, offset in offsets.items():
+        if os.path.exists(path) and os.path.getsize(path) > offset:
+            with open(path, 'r+') as f:
+                f.truncate(offset)
@@ -0,0 +1,230 @@
+'''
+This code is used to generate synthetic RT tickets for benchmarks, so the pipelines
+can be timed without production RT or MySQL. Tickets look like DesignSafe-ci tickets:
+portal tickets with an [HTTP Referer], rtbot user comments, staff answers, replies by
+email that quote earlier emails, [Reply from] proxies, forwards to other queues, file
+attachments and a few non-ascii emails. The same corpus can be served by
+mock_rt_server.py, or written as rt5 tables into SQLite or a MySQL-compatible SQL file.
+'''
+import datetime
+import random
+import re
+
+WORDS = ("job allocation queue node compute storage project data upload download file portal account "
+         "login password error failed running submit simulation model analysis jupyter hub workspace "
+         "container tapis app permission folder shared publication dataset curation doi review access "
+         "please help thanks issue problem works again now today tomorrow week access request granted").split()
+STAFF = ["jsmith", "mlopez", "achen", "rpatel"]
+QUEUE = "DesignSafe-ci"
+OTHER_QUEUES = ["High Performance Computing", "Accounting", "Frontera"]
+CATEGORIES = ["Data Depot", "Workspace", "Data Publication", "Login/Account", "Other"]
+
+
+def sentence(rng, n_min=6, n_max=18):
+    words = rng.choices(WORDS, k=rng.randint(n_min, n_max))
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, lines_min=1, lines_max=4):
+    return "\n".join(sentence(rng) for _ in range(rng.randint(lines_min, lines_max)))
+
+
+def rt_date(day):
+    return day.strftime("%a %b %d %H:%M:%S %Y")
+
+
+def quoted(rng, text, day, author):
+    """A quote of an earlier email, as mail clients write it."""
+    header = f"On {day.strftime('%a, %b %d, %Y')} at 10:{rng.randint(10, 59)} AM {author} wrote:"
+    return header + "\n" + "\n".join("> " + line for line in text.split("\n"))
+
+
+class Corpus:
+    """Synthetic tickets and their history items, in the shape RT REST 1.0 returns them."""
+    def __init__(self, n_tickets, seed=0, attachment_rate=0.05, forward_rate=0.05, non_ascii_rate=0.02,
+                 first_id=100000, start=datetime.datetime(2020, 1, 1)):
+        self.rng = random.Random(seed)
+        self.tickets = []          # search results: id, Queue, Subject, Created, LastUpdated, Requestors
+        self.histories = {}        # ticket id -> history items
+        self.attachments = {}      # attachment id -> (ticket id, name, content type, content)
+        self.next_item = 1
+        for n in range(n_tickets):
+            created = start + datetime.timedelta(hours=7 * n)
+            self._ticket(first_id + n, created, attachment_rate, forward_rate, non_ascii_rate)
+
+    def _item(self, ticket_id, day, type_, description, content, creator, files=()):
+        item_id = self.next_item
+        self.next_item += 1
+        attachments = []
+        # Every email is stored as an unnamed MIME part, now and then twice as
+        # text/html too, which the db_* scripts drop as duplicates. Files are named parts.
+        parts = [("", "text/plain", content)]
+        if content and self.rng.random() < 0.15:
+            parts.append(("", "text/html", content))
+        for name, ctype, body in parts + list(files):
+            att_id = self.next_item
+            self.next_item += 1
+            self.attachments[att_id] = (ticket_id, name, ctype, body)
+            attachments.append(att_id)
+        return {"id": str(item_id), "Ticket": str(ticket_id), "TimeTaken": "0", "Type": type_,
+                "Field": "", "OldValue": "", "NewValue": "", "Data": "", "Description": description,
+                "Content": content, "Creator": creator, "Created": day.strftime("%Y-%m-%d %H:%M:%S"),
+                "Attachments": attachments}
+
+    def _ticket(self, ticket_id, created, attachment_rate, forward_rate, non_ascii_rate):
+        rng = self.rng
+        user = f"user{rng.randint(1, 5000)}"
+        email = f"{user}@university.edu"
+        name = rng.choice(["Alex", "Sam", "Jordan", "Taylor", "Riley"])
+        staff = rng.choice(STAFF)
+        subject = sentence(rng, 3, 7)
+        day = created
+        question = paragraph(rng, 2, 5)
+        if rng.random() < non_ascii_rate:
+            question += "\nMerci, très bien."
+        history = [self._item(ticket_id, day, "Create", f"Ticket created by {user}",
+                              f"A ticket has been created in the {QUEUE} Queue.\n[Opened by] {user}\n"
+                              f"[Category] {rng.choice(CATEGORIES)}\n[Resource] DesignSafe\n\n"
+                              f"[HTTP Referer] https://www.designsafe-ci.org/help/new-ticket/\n{question}",
+                              user)]
+        history.append(self._item(ticket_id, day, "Comment", "Comments added by rtbot",
+                                  f"Username:..................... {user}\nEmail:........................ {email}\n"
+                                  f"Name:......................... {name} Doe\n", "RT_System"))
+        previous, previous_author = question, user
+        for turn in range(rng.randint(1, 6)):
+            day += datetime.timedelta(hours=rng.randint(1, 48))
+            answer = f"Hi {name},\n\n{paragraph(rng)}\n\nBest,\n{staff}\n--\nDesignSafe Support"
+            if turn == 0 and rng.random() < forward_rate:
+                answer = f"I am forwarding this ticket to the {rng.choice(OTHER_QUEUES)} Queue team.\n" + answer
+            files = []
+            if rng.random() < attachment_rate:
+                files.append(("job_log.txt", "text/plain", paragraph(rng)))
+            history.append(self._item(ticket_id, day, "Correspond", f"Correspondence added by {staff}",
+                                      answer, staff, files))
+            previous, previous_author = answer, staff
+            if rng.random() < 0.6:
+                day += datetime.timedelta(hours=rng.randint(1, 48))
+                reply = paragraph(rng)
+                if rng.random() < 0.5:
+                    # Reply by email, quoting the answer
+                    history.append(self._item(ticket_id, day, "Correspond", f"Correspondence added by {email}",
+                                              reply + "\n\n" + quoted(rng, previous, day, previous_author), user))
+                else:
+                    # Reply through the portal, added by rtprod on behalf of the user
+                    history.append(self._item(ticket_id, day, "Correspond", "Correspondence added by rtprod",
+                                              f"[Reply from] {user}\n{reply}", "rtprod"))
+                previous, previous_author = reply, user
+        day += datetime.timedelta(hours=rng.randint(1, 72))
+        history.append(self._item(ticket_id, day, "Status", f"Status changed from 'open' to 'resolved' by {staff}",
+                                  "", staff))
+        self.histories[str(ticket_id)] = history
+        self.tickets.append({"id": f"ticket/{ticket_id}", "Queue": QUEUE, "Subject": subject,
+                             "Status": "resolved", "Created": rt_date(created), "LastUpdated": rt_date(day),
+                             "Requestors": email})
+
+    def search(self, from_date=None, to_date=None):
+        """Tickets created in [from_date, to_date), dates as YYYY-MM-DD."""
+        def created(ticket):
+            return datetime.datetime.strptime(ticket["Created"], "%a %b %d %H:%M:%S %Y").strftime("%Y-%m-%d")
+        return [t for t in self.tickets
+                if (from_date is None or created(t) >= from_date) and (to_date is None or created(t) < to_date)]
+
+
+# rt5 tables read by db_reader and rt_db_history, with types both SQLite and MySQL accept
+SCHEMA = """
+CREATE TABLE Queues (id INTEGER PRIMARY KEY, Name VARCHAR(200));
+CREATE TABLE Users (id INTEGER PRIMARY KEY, Name VARCHAR(200));
+CREATE TABLE Tickets (id INTEGER PRIMARY KEY, EffectiveId INTEGER, Queue INTEGER, Subject VARCHAR(200),
+                      Status VARCHAR(64), Created DATETIME, LastUpdated DATETIME);
+CREATE TABLE Transactions (id INTEGER PRIMARY KEY, ObjectType VARCHAR(64), ObjectId INTEGER,
+                           Type VARCHAR(20), Created DATETIME, Creator INTEGER, TimeTaken INTEGER,
+                           Field VARCHAR(40), OldValue VARCHAR(255), NewValue VARCHAR(255), Data VARCHAR(255));
+CREATE TABLE Attachments (id INTEGER PRIMARY KEY, TransactionId INTEGER, Parent INTEGER, Subject VARCHAR(255),
+                          Filename VARCHAR(255), ContentType VARCHAR(80), Headers TEXT, Content LONGBLOB,
+                          ContentEncoding VARCHAR(80));
+"""
+
+
+def _db_date(day):
+    return datetime.datetime.strptime(day, "%a %b %d %H:%M:%S %Y").strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _sql_value(value, dialect="mysql"):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        return "X'" + value.hex() + "'"
+    if isinstance(value, int):
+        return str(value)
+    if dialect == "mysql":
+        # MySQL reads backslashes in strings as escapes, SQLite keeps them as they are
+        value = value.replace("\\", "\\\\")
+    return "'" + value.replace("'", "''") + "'"
+
+
+def table_rows(corpus):
+    """Rows of every rt5 table for the corpus, as {table: [tuple]}."""
+    rows = {"Queues": [(1, QUEUE)], "Users": [], "Tickets": [], "Transactions": [], "Attachments": []}
+    users = {}
+    for ticket in corpus.tickets:
+        ticket_id = int(ticket["id"].split("/")[1])
+        rows["Tickets"].append((ticket_id, ticket_id, 1, ticket["Subject"], ticket["Status"],
+                                _db_date(ticket["Created"]), _db_date(ticket["LastUpdated"])))
+        for item in corpus.histories[str(ticket_id)]:
+            # RT writes the Description from the user name and the old and new values
+            name = item["Description"].rsplit(" by ", 1)[-1]
+            user = users.setdefault(name, len(users) + 1)
+            values = re.findall(r"'([^']*)'", item["Description"]) if item["Type"] == "Status" else ["", ""]
+            rows["Transactions"].append((int(item["id"]), "RT::Ticket", ticket_id, item["Type"], item["Created"],
+                                         user, 0, item["Field"], values[0], values[1], item["Data"]))
+            if not item["Content"]:
+                continue
+            subject = ("Re: " if item["Type"] == "Correspond" else "") + ticket["Subject"]
+            for att_id in item["Attachments"]:
+                _, name, ctype, body = corpus.attachments[att_id]
+                headers = f"X-RT-Ticket: tacc.utexas.edu #{ticket_id}\nSubject: {subject}\nContent-Type: {ctype}\n"
+                # Non-ascii emails are stored in latin-1 now and then, which utf-8 cannot decode
+                encoding = "latin-1" if "très" in body and ticket_id % 2 else "utf-8"
+                rows["Attachments"].append((att_id, int(item["id"]), 0, subject, name or None, ctype, headers,
+                                            body.encode(encoding), "none"))
+    rows["Users"] = [(user, name) for name, user in users.items()]
+    return rows
+
+
+def write_sql(corpus, path, batch=500, dialect="mysql"):
+    """Write the rt5 tables of the corpus as SQL that loads into MySQL, or into SQLite with dialect="sqlite"."""
+    with open(path, "w") as f:
+        f.write(SCHEMA)
+        for table, rows in table_rows(corpus).items():
+            for i in range(0, len(rows), batch):
+                values = ",\n".join("(" + ", ".join(_sql_value(v, dialect) for v in row) + ")" for row in rows[i:i + batch])
+                f.write(f"INSERT INTO {table} VALUES\n{values};\n")
+
+
+def write_sqlite(corpus, path):
+    """Write the rt5 tables of the corpus into a new SQLite database."""
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    for table, rows in table_rows(corpus).items():
+        if rows:
+            conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate a synthetic rt5 database fixture')
+    parser.add_argument('--Tickets', type=int, default=1000, help='Number of tickets')
+    parser.add_argument('--Seed', type=int, default=0, help='Seed of the generator')
+    parser.add_argument('--Sqlite', help='SQLite database to write')
+    parser.add_argument('--Sql', help='SQL file to write, loads into MySQL, e.g. mysql rt5 < file.sql')
+    parser.add_argument('--SqlDialect', choices=['mysql', 'sqlite'], default='mysql',
+                        help='Database the SQL file is for, they escape strings differently')
+    args = parser.parse_args()
+    corpus = Corpus(args.Tickets, seed=args.Seed)
+    if args.Sqlite:
+        write_sqlite(corpus, args.Sqlite)
+    if args.Sql:
+        write_sql(corpus, args.Sql, dialect=args.SqlDialect)
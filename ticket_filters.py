@@ -0,0 +1,257 @@
+'''
+This code is used to filter and clean the tickets grouped by the db_* scripts.
+Each ticket's emails are split into lines and classified once, and a pipeline of
+stages (stand alone, forwarded, sanity, line cleaning, minimum turns, queue) runs
+over that shared representation one ticket at a time. Every stage counts the
+tickets going in and out and the time it takes, so the slow ones are easy to spot.
+Tickets are independent, so batches of them can also be cleaned in a process pool.
+'''
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import multiprocessing
+import re
+import time
+from line_classifier import db_classifier, DROP, STOP_QUOTED, STOP_FORWARD, REJECT
+
+
+class Ticket:
+    """Emails of a ticket, with their lines and line classifications computed once."""
+    def __init__(self, key, emails):
+        self.key = key
+        self.emails = emails
+        self.lines = [email['Email_Content'].split('\n') for email in emails]
+        self._flags = None
+        self.sane = list(range(len(emails)))   # emails that passed the sanity check
+        self.cleaned_emails = []
+        self.category, self.queue = "", ""
+
+    @property
+    def flags(self):
+        """(line flags, email flags) of every email, classified on first use."""
+        if self._flags is None:
+            self._flags = [db_classifier.classify_lines(lines) for lines in self.lines]
+        return self._flags
+
+
+class Stage(ABC):
+    """A step of the pipeline. `keep` returns False to drop the ticket, and may fill in its fields."""
+    name = "stage"
+
+    def __init__(self):
+        self.tickets_in, self.tickets_out, self.seconds = 0, 0, 0.0
+
+    @abstractmethod
+    def keep(self, ticket):
+        pass
+
+    def __call__(self, ticket):
+        start = time.perf_counter()
+        self.tickets_in += 1
+        kept = self.keep(ticket)
+        self.tickets_out += kept
+        self.seconds += time.perf_counter() - start
+        return kept
+
+    def reset(self):
+        self.tickets_in, self.tickets_out, self.seconds = 0, 0, 0.0
+
+    def merge(self, other):
+        """Add the counts of the same stage run on other tickets, e.g. in a worker process."""
+        self.tickets_in += other.tickets_in
+        self.tickets_out += other.tickets_out
+        self.seconds += other.seconds
+
+
+class StandAlone(Stage):
+    """Drop tickets of a single email, there is no conversation to learn from."""
+    name = "stand-alone"
+
+    def keep(self, ticket):
+        return len(ticket.emails) > 1
+
+
+class Forwarded(Stage):
+    """Drop tickets forwarded to another team, they are not a good case to learn from."""
+    name = "forwarded"
+
+    def __init__(self):
+        super().__init__()
+        self.keys = set()
+
+    def keep(self, ticket):
+        if any(email_flags & STOP_FORWARD for _, email_flags in ticket.flags):
+            self.keys.add(ticket.key)
+            return False
+        return True
+
+    def reset(self):
+        super().reset()
+        self.keys = set()
+
+    def merge(self, other):
+        super().merge(other)
+        self.keys |= other.keys
+
+
+class Sanity(Stage):
+    """Leave out emails with nothing to learn from, and tickets left without any email."""
+    name = "sanity"
+
+    def keep(self, ticket):
+        ticket.sane = [i for i in ticket.sane if not ticket.flags[i][1] & REJECT]
+        return len(ticket.sane) > 0
+
+
+class CleanLines(Stage):
+    """Keep the useful lines of every email, up to the start of quoted conversation."""
+    name = "clean-lines"
+
+    def keep(self, ticket):
+        for i in ticket.sane:
+            cleaned_lines = []
+            for line, flags in zip(ticket.lines[i], ticket.flags[i][0]):
+                # Must break the loop if the next line contains history email conversation
+                if flags & STOP_QUOTED:
+                    break
+                if not flags & DROP:
+                    cleaned_lines.append(line.replace("\r", ""))
+            if len(cleaned_lines) != 0:
+                ticket.cleaned_emails.append("\n".join(cleaned_lines))
+        return len(ticket.cleaned_emails) > 0
+
+
+class MinTurns(Stage):
+    """Avoid the case where tickets do not have any response."""
+    name = "min-turns"
+
+    def __init__(self, turns=2):
+        super().__init__()
+        self.turns = turns
+
+    def keep(self, ticket):
+        return len(ticket.cleaned_emails) >= self.turns
+
+
+class Queue(Stage):
+    """Find the category and queue of a ticket, and keep only `queues` if given."""
+    name = "queue"
+
+    def __init__(self, queues=None):
+        super().__init__()
+        self.queues = set(queues) if queues else None
+
+    def keep(self, ticket):
+        for i, lines in enumerate(ticket.lines):
+            if i == 0:
+                ticket.category = get_category(lines)
+            queue_info = get_queue(lines)
+            if not ticket.queue or queue_info:
+                ticket.queue = queue_info
+        return self.queues is None or ticket.queue in self.queues
+
+
+class Pipeline:
+    """Run tickets through the stages in order, dropping them at the first stage that says so.
+
+    With `processes` > 1, batches of `batch_size` tickets are cleaned in a process
+    pool and the kept tickets come back in the same order as a serial run.
+    """
+    def __init__(self, stages, processes=1, batch_size=256):
+        self.stages = stages
+        self.processes = processes
+        self.batch_size = batch_size
+
+    def run(self, tickets):
+        """Yield the kept Tickets of a {key: emails} dict or (key, emails) iterable, in order."""
+        if self.processes > 1:
+            yield from self._run_parallel(tickets)
+            return
+        items = tickets.items() if isinstance(tickets, dict) else tickets
+        for key, emails in items:
+            ticket = Ticket(key, emails)
+            if all(stage(ticket) for stage in self.stages):
+                yield ticket
+
+    def _run_parallel(self, tickets):
+        # A dict of tickets is handed to the workers when they start, which costs
+        # nothing with fork, so batches only carry ticket keys. Tickets of an
+        # iterable are sent along with their batch.
+        shared = tickets if isinstance(tickets, dict) else None
+        items = iter(tickets.keys() if shared is not None else tickets)
+        context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(self.processes, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.stages, shared)) as executor:
+            pending = deque()
+            while True:
+                while len(pending) < 2 * self.processes:
+                    batch = [item for _, item in zip(range(self.batch_size), items)]
+                    if not batch:
+                        break
+                    pending.append(executor.submit(_clean_batch, batch))
+                if not pending:
+                    break
+                kept, stages = pending.popleft().result()
+                for stage, worker_stage in zip(self.stages, stages):
+                    stage.merge(worker_stage)
+                for ticket in kept:
+                    ticket.emails = shared[ticket.key] if shared is not None else ticket.emails
+                    yield ticket
+
+    def report(self):
+        for stage in self.stages:
+            print(f"{stage.name:>12}: {stage.tickets_in} -> {stage.tickets_out} tickets, {stage.seconds:.2f}s")
+
+
+_worker = {}
+
+
+def _init_worker(stages, tickets):
+    _worker["stages"], _worker["tickets"] = stages, tickets
+
+
+def _clean_batch(batch):
+    # Fresh copies of the stages, so their counts are those of this batch only
+    stages = copy.deepcopy(_worker["stages"])
+    for stage in stages:
+        stage.reset()
+    tickets = _worker["tickets"]
+    kept = []
+    for item in batch:
+        key, emails = (item, tickets[item]) if tickets is not None else item
+        ticket = Ticket(key, emails)
+        if all(stage(ticket) for stage in stages):
+            # Send back only what the kept ticket is used for, the parent has the emails
+            ticket.lines, ticket._flags = None, None
+            if tickets is not None:
+                ticket.emails = None
+            kept.append(ticket)
+    return kept, stages
+
+
+def default_stages(queues=None):
+    return [StandAlone(), Forwarded(), Sanity(), CleanLines(), MinTurns(2), Queue(queues)]
+
+
+def get_category(email_splited):
+    for line in email_splited:
+        if "[Category]" in line:
+            return line.replace("[Category]", "")
+    return None
+
+
+def get_queue(email_splited):
+    Q_list = [' Chameleon ', ' High Performance Computing ', ' Technology Infrastructure ', ' Data Intensive Computing ', ' Security ', ' Visualization ', ' DesignSafe-ci ', ' Accounting ', ' Agave ', ' Advanced Computing Interfaces ', ' Life Sciences ', ' Advanced Computing Systems ', ' SD2E ', ' TRADES ', ' Cloud and Interactive Computing ', ' Dell Medical School ', ' Web & Mobile Apps ', ' TUP ', ' Frontera ', ' Epic ', ' NSO ', ' Designsafe-pub-feedback ', ' EPIC-CyberRange ', ' 3DEM ', ' Accounts ', ' Allocations ', ' Citizenship ', ' Feature-Requests ', ' Machine Learning ', ' MFA ', ' PDATA ']
+    for line in email_splited:
+        if re.search(r"A ticket has been created in the .*? Queue.", line):
+            return " ".join(line.split(" ")[7:-1])
+        if re.search(r"A ticket has been transferred to the .*? Queue.", line):
+            return " ".join(line.split(" ")[7:-1])
+        if re.search(r"Queue changed from .*? to .*?", line):
+            return line.split("to")[1]
+    for line in email_splited:
+        for q in Q_list:
+            if q in line:
+                return q[1:-1]
+    return None